@@ -20,14 +20,41 @@
 #       Game connect and disconnect messages.
 #       Sending and receiving game status requests.
 #       Game Status (all connected games, and single game)
+#       Non-blocking connect (DNS, TCP, TLS and websocket upgrade) with a timeout.
+#       Coalesced player status queries (merged full queries, per game refresh limits).
+#       Game directory cache of games/status data with shared in-flight queries.
+#       Bounded per channel chat history.
+#       Per player and per channel send rate limits, fair outbound queueing.
+#       Foreign player cache snapshots for warm restarts.
+#       Outbound spool that keeps sign-ins, sign-outs, tells and chat across disconnects.
+#       permessage-deflate compression, with traffic and compression stats.
+#       Lazy decoding that skips frames the game has no interest in.
+#       Handler registry, attach your own handlers with @gsocket.on("event").
+#       Slow handler watchdog with stack samples and a table of the slowest handlers.
+#       Gateway mode, running the Grapevine connection in a sidecar process.
+#       Optional tell target checks against the foreign player cache, with suggestions.
+#       Websocket ping liveness checks with round trip time stats.
+#       Roster sync, sending everyone online in one frame on connect.
+#       Memory report of every cache and buffer, optionally traced with tracemalloc.
+#       Soak test for memory growth over a simulated day, see memory_soak.py.
+#       Sign-in/sign-out flap suppression for players who quit and come straight back.
+#       Batched writes, several queued frames per socket send.
+#       Foreign player cache shared through a memory mapped file with other processes.
+#       Blocking handlers run on a thread pool, in order per channel or player.
+#       Large players/status lists parsed a slice per pulse instead of all at once.
+#       Batch processing of inbound frames, with per game sign-in/sign-out digests.
+#       Hot reload of this module without dropping the connection.
+#       Structured debug log with a background writer, sampling and secret redaction.
+#       Optional lean built in websocket framing, with fewer copies and socket reads than websocket-client.
 #
 #
 # Example usage would be to import this module into your main game server.  During server startup
 # assign grapevine.gsocket to grapevine.GrapevineSocket().  After instance init is when you need
-# to connect via grapevine.gsocket.gsocket_connect().  PLEASE PUT YOUR CLIENT ID AND CLIENT SECRET
+# to connect via grapevine.gsocket.gsocket_connect().  The connect is non-blocking and is
+# completed by the handle_read() and handle_write() calls described below.  PLEASE PUT YOUR CLIENT ID AND CLIENT SECRET
 # into the appropriate instance attributes of GrapevineSocket below.  Please note the instance
-# attribute in GrapevineSocket of debug, set to True if you would like to print to stdout various
-# things that happen to help with debugging.
+# attribute in GrapevineSocket of debug, set to True if you would like a log of various things
+# that happen to help with debugging.  It is written to stdout by a background thread, see DebugLog.
 #
 # You will need to periodically call the gsocket.handle_read() and gsocket.handle_write() as
 # required by your configuration.   Please see the examples in the repo of how this might look
@@ -62,12 +89,33 @@
 '''
 
 
+import array
+import base64
+import collections
+import concurrent.futures
 import datetime
+import difflib
+import errno
+import hashlib
 import json
+import marshal
+import mmap
+import os
+import re
+import select
 import socket
+import ssl
+import struct
+import sys
+import threading
 import time
+import tracemalloc
+import traceback
+import types
+import urllib.parse
 import uuid
-from websocket import WebSocket
+import zlib
+from websocket import ABNF, WebSocket, WebSocketConnectionClosedException
 
 # The below imports are for Akrios.  PLEASE LOOK BELOW FOR COMMENTS WITH XXX
 # in them to see how I tied in my side.  You can safetly ignore some of them
@@ -78,58 +126,1310 @@ from keys import CLIENT_ID, SECRET_KEY
 #import player
 #import world
 
+
+# The GUID every websocket server appends to our key when accepting the upgrade (RFC 6455).
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# The below build and parse websocket frame headers without websocket-client's ABNF, see
+# GrapevineSocket.lean_framing.  Every frame a client sends is masked (RFC 6455 5.3).
+_frame_short = struct.Struct("!BB")
+_frame_medium = struct.Struct("!BBH")
+_frame_long = struct.Struct("!BBQ")
+
+
+def mask_payload(mask, data):
+    '''
+    XOR data with the 4 byte mask, as one big integer operation over the whole buffer
+    rather than byte by byte.  data may be any bytes-like object, a memoryview included.
+
+    return the masked (or unmasked, it is its own inverse) bytes.
+    '''
+    size = len(data)
+    if not size:
+        return b""
+    key = mask * (size >> 2) + mask[:size & 3]
+    return (int.from_bytes(data, "little") ^ int.from_bytes(key, "little")).to_bytes(size, "little")
+
+
+def ws_frame(opcode, payload, fin=1, rsv1=0):
+    '''
+    return the bytes of one masked client frame carrying payload.
+    '''
+    first = fin << 7 | rsv1 << 6 | opcode
+    size = len(payload)
+    if size < 126:
+        header = _frame_short.pack(first, 0x80 | size)
+    elif size < 65536:
+        header = _frame_medium.pack(first, 0x80 | 126, size)
+    else:
+        header = _frame_long.pack(first, 0x80 | 127, size)
+    mask = os.urandom(4)
+    return b"".join((header, mask, mask_payload(mask, payload)))
+
+
+# Addresses we have already resolved, keyed by (host, port).  Each value is a tuple of
+# (expires_at, getaddrinfo list).  Lookups run on a single worker thread so a slow
+# resolver can never stall the game loop.
+DNS_CACHE_TTL = 300
+_dns_cache = {}
+_dns_pending = {}
+_dns_lock = threading.Lock()
+_dns_executor = None
+
+
+def resolve_address(host, port):
+    '''
+    Resolve host and port without blocking the caller.
+
+    return a concurrent.futures.Future whose result is a getaddrinfo() list.  Cached
+    addresses come back as an already completed future, and lookups for an address
+    that is already being resolved share the one in flight.
+    '''
+    global _dns_executor
+
+    key = (host, port)
+    with _dns_lock:
+        cached = _dns_cache.get(key)
+        if cached and cached[0] > time.time():
+            future = concurrent.futures.Future()
+            future.set_result(cached[1])
+            return future
+        if key in _dns_pending:
+            return _dns_pending[key]
+        if _dns_executor is None:
+            _dns_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                  thread_name_prefix="grapevine-dns")
+        future = _dns_executor.submit(socket.getaddrinfo, host, port, 0, socket.SOCK_STREAM)
+        _dns_pending[key] = future
+
+    def cache_result(done):
+        with _dns_lock:
+            _dns_pending.pop(key, None)
+            if done.exception() is None:
+                _dns_cache[key] = (time.time() + DNS_CACHE_TTL, done.result())
+
+    future.add_done_callback(cache_result)
+    return future
+
+
+# Patterns that pull a top level string field out of a raw frame.  A quote inside a JSON
+# string is always escaped, so "key": can only match a real key.
+_sniff_patterns = {}
+
+
+def sniff_field(message, key):
+    '''
+    Cheaply read the string value of key from raw frame text without decoding it.
+
+    return the first value found, or None.
+    '''
+    pattern = _sniff_patterns.get(key)
+    if pattern is None:
+        pattern = _sniff_patterns[key] = re.compile(rf'"{key}"\s*:\s*"([^"\\]*)"')
+    match = pattern.search(message)
+    return match.group(1) if match else None
+
+
+_players_start = re.compile(r'"players"\s*:\s*\[')
+_json_space = re.compile(r"[ \t\n\r]*")
+_json_plain_string = re.compile(r'"([^"\\]*)"')
+_json_decoder = json.JSONDecoder()
+
+
+class PlayerListStream(object):
+    '''
+    Parses the "players" list of a raw players/status frame a slice at a time, so a
+    huge list does not hold up the game loop in one go.  Names are capitalized as they
+    are parsed, straight into players.  A list that turns out to be malformed is given
+    up on, done with error set.
+
+    Sign-ins and sign-outs for the game that arrive meanwhile are newer than the list,
+    they are kept in changes as (signed_in, player) to be applied after it.
+    '''
+    def __init__(self, message, position):
+        super().__init__()
+        self.message = message
+        self.position = position
+        self.players = []
+        self.changes = []
+        self.done = False
+        self.error = None
+
+    def step(self, count):
+        '''
+        Parse up to count more names.
+
+        return how many entries were parsed.
+        '''
+        message = self.message
+        position = self.position
+        parsed = 0
+        try:
+            while parsed < count:
+                position = _json_space.match(message, position).end()
+                if message[position] == "]":
+                    self.done = True
+                    self.message = None
+                    break
+                if message[position] == ",":
+                    position = _json_space.match(message, position + 1).end()
+                # Most names have nothing escaped in them and need no decoding.
+                plain = _json_plain_string.match(message, position)
+                if plain:
+                    name, position = plain.group(1), plain.end()
+                else:
+                    name, position = _json_decoder.raw_decode(message, position)
+                if name:
+                    self.players.append(name.capitalize())
+                parsed += 1
+        except (ValueError, IndexError, AttributeError) as err:
+            self.error = f"Bad player list at offset {position}: {err!r}"
+            self.done = True
+            self.message = None
+        self.position = position
+        return parsed
+
+
+# The below are not walked into by deep_sizeof(), they are shared with the rest of the
+# program or are not ours to count.
+_sizeof_opaque = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                  types.MethodType, threading.Thread, socket.socket)
+
+
+def deep_sizeof(obj):
+    '''
+    Approximate the memory held by obj: its own size plus that of everything reachable
+    through its containers, attributes and slots, counting each object once.
+
+    return the size in bytes.
+    '''
+    seen = set()
+    pending = [obj]
+    total = 0
+    while pending:
+        each_obj = pending.pop()
+        if id(each_obj) in seen:
+            continue
+        seen.add(id(each_obj))
+        total += sys.getsizeof(each_obj)
+
+        if isinstance(each_obj, _sizeof_opaque):
+            continue
+        if isinstance(each_obj, (str, bytes, bytearray, int, float, array.array)):
+            continue
+        if isinstance(each_obj, dict):
+            pending.extend(each_obj.keys())
+            pending.extend(each_obj.values())
+        elif isinstance(each_obj, (list, tuple, set, frozenset, collections.deque)):
+            pending.extend(each_obj)
+        if hasattr(each_obj, "__dict__"):
+            pending.append(vars(each_obj))
+        for each_slot in getattr(type(each_obj), "__slots__", ()):
+            if hasattr(each_obj, each_slot):
+                pending.append(getattr(each_obj, each_slot))
+    return total
+
+
+def rebind_classes(root):
+    '''
+    After this module is reloaded, point every object reachable from root that is an
+    instance of one of the old module's classes at the class of the same name in the
+    module as it is now.
+
+    return the number of objects rebound.
+    '''
+    module_globals = globals()
+    seen = set()
+    pending = [root]
+    count = 0
+    while pending:
+        each_obj = pending.pop()
+        if id(each_obj) in seen:
+            continue
+        seen.add(id(each_obj))
+
+        if isinstance(each_obj, dict):
+            pending.extend(each_obj.values())
+            continue
+        if isinstance(each_obj, (list, tuple, set, frozenset, collections.deque)):
+            pending.extend(each_obj)
+            continue
+
+        old_class = type(each_obj)
+        if old_class.__module__ != __name__:
+            continue
+        new_class = module_globals.get(old_class.__name__)
+        if isinstance(new_class, type) and new_class is not old_class:
+            each_obj.__class__ = new_class
+            count += 1
+        if hasattr(each_obj, "__dict__"):
+            pending.append(vars(each_obj))
+        for each_slot in getattr(old_class, "__slots__", ()):
+            if hasattr(each_obj, each_slot):
+                pending.append(getattr(each_obj, each_slot))
+    return count
+
+
+def game_key(game):
+    '''
+    return the key game is filed under in other_games_players, stale_games and the
+    query limits.  Grapevine's own spelling of the name is kept in game_names.
+    '''
+    return game.capitalize()
+
+
+def check_tell_target(game, target, other_games_players, stale_games=(), known_games=None):
+    '''
+    Decide from the foreign player cache whether target@game can be reached.  Only a
+    certain miss is refused: the game is missing from a complete known_games list, or
+    its player list is current and does not have target.  Anything we are unsure of,
+    like a stale game or a game with nobody listed, is left for Grapevine to answer.
+
+    return (game, target) with the names as Grapevine knows them, or a SendRejected
+    with suggestions.
+    '''
+    games = {name.lower(): name for name in other_games_players}
+    if known_games:
+        for name in known_games:
+            games.setdefault(name.lower(), name)
+    game = games.get(game.lower(), game)
+
+    if known_games is not None and game.lower() not in games:
+        close = difflib.get_close_matches(game.lower(), games, n=3, cutoff=0.6)
+        suggestions = [f"{target}@{games[each_game]}" for each_game in close]
+        reason = f"There is no game called {game} on Grapevine."
+        if suggestions:
+            reason += f"  Did you mean {' or '.join(suggestions)}?"
+        return SendRejected(reason, suggestions)
+
+    players = other_games_players.get(game)
+    if not players or game in stale_games:
+        return game, target
+
+    names = {name.lower(): name for name in players}
+    if target.lower() in names:
+        return game, names[target.lower()]
+
+    close = difflib.get_close_matches(target.lower(), names, n=3, cutoff=0.6)
+    suggestions = [f"{names[each_name]}@{game}" for each_name in close]
+    reason = f"{target} is not online at {game}."
+    if suggestions:
+        reason += f"  Did you mean {' or '.join(suggestions)}?"
+    return SendRejected(reason, suggestions)
+
+
+class PlayerStatusCoalescer(object):
+    '''
+    Decides which players/status queries are worth sending to the network.
+
+    A full (every game) query sent within full_window seconds of the previous one is
+    merged into it, and a single game is not queried again within min_refresh seconds of
+    its last query or response.  metrics counts what was sent and what was saved.
+    '''
+    def __init__(self, full_window=30, min_refresh=60):
+        super().__init__()
+        self.full_window = full_window
+        self.min_refresh = min_refresh
+        self.last_full = 0
+        self.last_refresh = {}
+        self.metrics = {"full_sent": 0,
+                        "full_merged": 0,
+                        "single_sent": 0,
+                        "single_suppressed": 0,
+                        "saved": 0}
+
+    def allow_full(self):
+        '''
+        return True if a full query should go out now, False if it merges into the last.
+        '''
+        now = time.time()
+        if now - self.last_full < self.full_window:
+            self.metrics["full_merged"] += 1
+            self.metrics["saved"] += 1
+            return False
+
+        self.last_full = now
+        self.metrics["full_sent"] += 1
+        return True
+
+    def allow_single(self, game):
+        '''
+        return True if a single game query for game should go out now.
+        '''
+        game = game_key(game)
+        now = time.time()
+        if now - self.last_refresh.get(game, 0) < self.min_refresh:
+            self.metrics["single_suppressed"] += 1
+            self.metrics["saved"] += 1
+            return False
+
+        self.last_refresh[game] = now
+        self.metrics["single_sent"] += 1
+        return True
+
+    def refreshed(self, game):
+        '''
+        Record that we just received a full player list for game.
+        '''
+        self.last_refresh[game_key(game)] = time.time()
+
+    def forget(self, game):
+        '''
+        The game left the network, so the next time it connects it is queried right away.
+        '''
+        self.last_refresh.pop(game_key(game), None)
+
+    def clear(self):
+        self.last_full = 0
+        self.last_refresh.clear()
+
+
+class GameDirectory(object):
+    '''
+    A cache of the games/status metadata for the games on the network.
+
+    Entries expire after ttl seconds, or the ttl handed to store().  by_support indexes
+    the games by each capability in their "supports" list, so finding every game that
+    accepts tells is a single lookup.  While a game is being queried it is in flight and
+    later lookups wait on that query, or on an all games query, instead of sending their
+    own.  An in flight query that is not answered within inflight_timeout is given up on.
+
+    Grapevine does not say when the last game has answered an all games query, so it is
+    settled once it has answers and settle seconds pass without another.  Only then is
+    the directory complete.
+    '''
+    ALL = "*"
+
+    def __init__(self, ttl=600, inflight_timeout=30, settle=5):
+        super().__init__()
+        self.ttl = ttl
+        self.inflight_timeout = inflight_timeout
+        self.settle = settle
+        self.entries = {}
+        self.by_support = {}
+        self.inflight = {}
+        self.last_full = 0
+        self.full_answers = 0
+        self.last_answer = 0
+        # Every game answers an all games query with its ref, so the ref is kept until
+        # the next all games query replaces it, settled or not.
+        self.full_ref = None
+        self.metrics = {"hits": 0,
+                        "misses": 0,
+                        "shared": 0,
+                        "queries": 0}
+
+    def get(self, game):
+        '''
+        return the cached games/status payload for game, or None if unknown or expired.
+        '''
+        entry = self.entries.get(game.lower())
+        if entry and entry[0] > time.time():
+            return entry[1]
+
+    def games(self):
+        '''
+        return every unexpired games/status payload we know about.
+        '''
+        now = time.time()
+        return [info for expires, info in self.entries.values() if expires > now]
+
+    def supporting(self, capability):
+        '''
+        return the unexpired games/status payloads of games that support capability.
+        '''
+        now = time.time()
+        return [self.entries[key][1] for key in self.by_support.get(capability, ())
+                if self.entries[key][0] > now]
+
+    def is_complete(self):
+        '''
+        return True if an all games query made within the last ttl seconds has settled
+        and we know of at least one game.
+        '''
+        self.settle_full()
+        return bool(self.entries) and time.time() - self.last_full < self.ttl
+
+    def full_pending(self):
+        '''
+        return True if an all games query is still waiting for answers.
+        '''
+        self.settle_full()
+        return self.ALL in self.inflight
+
+    def settle_full(self):
+        # Retire the all games query in flight once its answers have stopped coming.
+        if self.ALL not in self.inflight or not self.full_answers:
+            return
+        if time.time() - self.last_answer < self.settle:
+            return
+        started, _, _ = self.inflight.pop(self.ALL)
+        self.last_full = started
+
+    def store(self, info, ttl=None):
+        '''
+        Cache a games/status payload and answer anyone waiting on that game.
+        '''
+        key = info["game"].lower()
+        self.evict(key)
+        self.entries[key] = (time.time() + (ttl or self.ttl), info)
+        if self.ALL in self.inflight:
+            self.full_answers += 1
+            self.last_answer = time.time()
+        for each_support in info.get("supports") or []:
+            self.by_support.setdefault(each_support, set()).add(key)
+
+        waiting = self.inflight.pop(key, None)
+        if waiting:
+            for each_callback in waiting[2]:
+                each_callback(info["game"], info)
+
+    def evict(self, game):
+        key = game.lower()
+        entry = self.entries.pop(key, None)
+        if entry:
+            for each_support in entry[1].get("supports") or []:
+                games = self.by_support.get(each_support)
+                if games:
+                    games.discard(key)
+                    if not games:
+                        self.by_support.pop(each_support)
+
+    def start(self, game, ref, callback=None):
+        '''
+        Record a query we just sent for game, or for every game if game is None.
+
+        return the ref of the all games query this one replaces, so it can be dropped.
+        '''
+        self.metrics["queries"] += 1
+        if game is None:
+            previous = self.full_ref
+            self.inflight[self.ALL] = [time.time(), ref, []]
+            self.full_ref = ref
+            self.full_answers = 0
+            return previous
+
+        self.inflight.setdefault(game.lower(), [time.time(), ref, []])
+        if callback:
+            self.inflight[game.lower()][2].append(callback)
+
+    def join(self, game, callback=None):
+        '''
+        Wait on a query already in flight for game, or on an all games query.
+
+        return True if there was one to wait on, False if a query needs to be sent.
+        '''
+        self.expire()
+        key = game.lower()
+        if key not in self.inflight:
+            if self.ALL not in self.inflight:
+                return False
+            started, ref, _ = self.inflight[self.ALL]
+            self.inflight[key] = [started, ref, []]
+
+        if callback:
+            self.inflight[key][2].append(callback)
+        self.metrics["shared"] += 1
+        return True
+
+    def failed(self, game):
+        '''
+        The query for game failed.  Tell anyone waiting on it that it is unknown.
+        '''
+        waiting = self.inflight.pop(game.lower(), None)
+        if waiting:
+            for each_callback in waiting[2]:
+                each_callback(game, None)
+
+    def expire(self):
+        '''
+        Give up on in flight queries that were never answered.
+        '''
+        cutoff = time.time() - self.inflight_timeout
+        for each_key in [key for key, value in self.inflight.items() if value[0] < cutoff]:
+            self.failed(each_key)
+
+    def cancel(self):
+        '''
+        Give up on every in flight query, used when we lose the connection.
+        '''
+        for each_key in list(self.inflight):
+            self.failed(each_key)
+
+
+class HistoryRing(object):
+    '''
+    The ring buffer behind one channel of ChannelHistory.  Slot i holds the packed
+    timestamp, the interned game and player ids and the message text of one line.
+    '''
+    __slots__ = ("times", "games", "names", "messages", "start", "count", "nbytes")
+
+    def __init__(self, capacity):
+        self.times = array.array("L", bytes(array.array("L").itemsize * capacity))
+        self.games = array.array("L", self.times)
+        self.names = array.array("L", self.times)
+        self.messages = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.nbytes = 0
+
+
+class ChannelHistory(object):
+    '''
+    A fixed size history of the chat on each channel.
+
+    Every channel gets a ring buffer of capacity lines, so memory stays flat however long
+    we are up.  Game and player names are interned once in a shared, reference counted
+    table and stored as integer ids, and timestamps are packed as whole seconds.  With
+    max_bytes set the oldest lines of a channel are also dropped once its message text
+    grows past that many bytes.
+
+    Lines come back oldest first as (timestamp, name, game, message) tuples.
+    '''
+    def __init__(self, capacity=100, max_bytes=None):
+        super().__init__()
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.rings = {}
+        self.intern_ids = {}
+        self.intern_names = []
+        self.intern_refs = []
+        self.intern_free = []
+
+    def _intern(self, name):
+        name_id = self.intern_ids.get(name)
+        if name_id is None:
+            if self.intern_free:
+                name_id = self.intern_free.pop()
+                self.intern_names[name_id] = name
+                self.intern_refs[name_id] = 0
+            else:
+                name_id = len(self.intern_names)
+                self.intern_names.append(name)
+                self.intern_refs.append(0)
+            self.intern_ids[name] = name_id
+        self.intern_refs[name_id] += 1
+        return name_id
+
+    def _release(self, name_id):
+        self.intern_refs[name_id] -= 1
+        if self.intern_refs[name_id] == 0:
+            self.intern_ids.pop(self.intern_names[name_id])
+            self.intern_names[name_id] = None
+            self.intern_free.append(name_id)
+
+    def _drop_oldest(self, ring):
+        index = ring.start
+        self._release(ring.games[index])
+        self._release(ring.names[index])
+        ring.nbytes -= len(ring.messages[index].encode("utf-8"))
+        ring.messages[index] = None
+        ring.start = (index + 1) % self.capacity
+        ring.count -= 1
+
+    def _line(self, ring, index):
+        return (ring.times[index],
+                self.intern_names[ring.names[index]],
+                self.intern_names[ring.games[index]],
+                ring.messages[index])
+
+    def add(self, channel, name, game, message, timestamp=None):
+        '''
+        Remember a line of chat on channel, pushing out the oldest line if full.
+        '''
+        ring = self.rings.get(channel)
+        if ring is None:
+            ring = self.rings[channel] = HistoryRing(self.capacity)
+
+        if ring.count == self.capacity:
+            self._drop_oldest(ring)
+
+        index = (ring.start + ring.count) % self.capacity
+        ring.times[index] = int(timestamp or time.time())
+        ring.games[index] = self._intern(game)
+        ring.names[index] = self._intern(name)
+        ring.messages[index] = message
+        ring.count += 1
+        ring.nbytes += len(message.encode("utf-8"))
+
+        if self.max_bytes:
+            while ring.nbytes > self.max_bytes and ring.count > 1:
+                self._drop_oldest(ring)
+
+    def last(self, channel, count):
+        '''
+        return up to the last count lines of channel.
+        '''
+        ring = self.rings.get(channel)
+        if ring is None:
+            return []
+
+        count = min(count, ring.count)
+        first = ring.start + ring.count - count
+        return [self._line(ring, each % self.capacity) for each in range(first, first + count)]
+
+    def since(self, channel, timestamp):
+        '''
+        return the lines of channel received at or after timestamp.
+        '''
+        ring = self.rings.get(channel)
+        if ring is None:
+            return []
+
+        lines = []
+        for each in range(ring.start + ring.count - 1, ring.start - 1, -1):
+            index = each % self.capacity
+            if ring.times[index] < timestamp:
+                break
+            lines.append(self._line(ring, index))
+        lines.reverse()
+        return lines
+
+    def clear(self, channel=None):
+        '''
+        Forget the history of channel, or of every channel.
+        '''
+        for each_channel in [channel] if channel else list(self.rings):
+            ring = self.rings.pop(each_channel, None)
+            while ring and ring.count:
+                self._drop_oldest(ring)
+
+
+class PresenceDigest(object):
+    '''
+    Gathers the sign-ins and sign-outs of other games' players so they can be announced
+    a game at a time.  A game's digest is due window seconds after its first change.
+    A player who signs in and back out, or out and back in, within it is left out.
+    '''
+    def __init__(self, window=5):
+        super().__init__()
+        self.window = window
+        self.games = {}
+        self.metrics = {"events": 0,
+                        "flaps": 0,
+                        "digests": 0}
+
+    def add(self, game, player, signed_in):
+        entry = self.games.get(game)
+        if entry is None:
+            entry = self.games[game] = (time.time(), {}, {})
+        self.metrics["events"] += 1
+
+        joined, left = (entry[1], entry[2]) if signed_in else (entry[2], entry[1])
+        if left.pop(player, None) is not None:
+            self.metrics["flaps"] += 1
+            return
+        joined[player] = True
+
+    def due(self, now=None):
+        '''
+        Take the digests that are due.
+
+        return a list of (game, [signed in players], [signed out players]).
+        '''
+        now = now or time.time()
+        digests = []
+        for game, (started, signed_in, signed_out) in list(self.games.items()):
+            if now - started < self.window:
+                continue
+            del self.games[game]
+            if signed_in or signed_out:
+                digests.append((game, list(signed_in), list(signed_out)))
+        self.metrics["digests"] += len(digests)
+        return digests
+
+
+class SendRejected(object):
+    '''
+    Returned by the msg_gen_* methods that act for a player when they refuse to send.
+    It is false in an if test, where a queued message returns True, and str() of it is
+    a reason you can show the player.  suggestions holds any "player@game" targets we
+    think the player meant.
+    '''
+    def __init__(self, reason, suggestions=()):
+        super().__init__()
+        self.reason = reason
+        self.suggestions = list(suggestions)
+
+    def __bool__(self):
+        return False
+
+    def __str__(self):
+        return self.reason
+
+    def __repr__(self):
+        return f"SendRejected({self.reason!r})"
+
+
+class RateLimiter(object):
+    '''
+    A token bucket per key.  Each bucket holds up to burst tokens and refills at rate
+    tokens per second, and every allowed send takes one.  Buckets that have refilled
+    completely carry no information and are pruned once there are more than max_keys.
+    '''
+    def __init__(self, rate, burst, max_keys=256):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.metrics = {"allowed": 0,
+                        "rejected": 0}
+
+    def allow(self, key):
+        '''
+        return True and take a token if key may send now, otherwise False.
+        '''
+        now = time.time()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            self.metrics["rejected"] += 1
+            return False
+
+        self.buckets[key] = (tokens - 1, now)
+        self.metrics["allowed"] += 1
+        if len(self.buckets) > self.max_keys:
+            self.prune()
+        return True
+
+    def refund(self, key):
+        '''
+        Give back the token key just took, when something else stopped the send.
+        '''
+        if key in self.buckets:
+            tokens, updated = self.buckets[key]
+            self.buckets[key] = (min(self.burst, tokens + 1), updated)
+            self.metrics["allowed"] -= 1
+
+    def prune(self):
+        now = time.time()
+        for each_key, (tokens, updated) in list(self.buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                self.buckets.pop(each_key)
+
+
+class FairOutboundQueue(object):
+    '''
+    The outbound frame buffer.
+
+    Frames the client sends for itself (authentication, heartbeats, subscriptions and
+    queries) go first, in the order they were queued.  Frames sent on behalf of a player
+    wait in that player's own queue and the players take turns, one frame each, so a
+    player flooding a channel cannot hold up everyone else's tells and sign-ins.
+
+    A frame can also be held back under a key until a given time, so that a later frame
+    may take it back out with unhold() before it is ever sent.  release() queues the held
+    frames that are due.  Held frames count in len().
+    '''
+    def __init__(self):
+        super().__init__()
+        self.system = collections.deque()
+        self.senders = {}
+        self.turns = collections.deque()
+        self.held = {}
+        self.length = 0
+
+    def __len__(self):
+        return self.length + len(self.held)
+
+    def __iter__(self):
+        yield from self.system
+        for each_sender in self.turns:
+            yield from self.senders[each_sender]
+        for _, _, each_frame in self.held.values():
+            yield each_frame
+
+    def append(self, frame, sender=None):
+        if sender is None:
+            self.system.append(frame)
+        else:
+            if sender not in self.senders:
+                self.senders[sender] = collections.deque()
+                self.turns.append(sender)
+            self.senders[sender].append(frame)
+        self.length += 1
+
+    def popleft(self):
+        '''
+        return the next frame to write.  Raises IndexError when empty, like a deque.
+        '''
+        if self.system:
+            frame = self.system.popleft()
+        elif self.turns:
+            sender = self.turns.popleft()
+            frame = self.senders[sender].popleft()
+            if self.senders[sender]:
+                self.turns.append(sender)
+            else:
+                self.senders.pop(sender)
+        else:
+            raise IndexError("pop from an empty outbound queue")
+
+        self.length -= 1
+        return frame
+
+    def hold(self, key, frame, release_at, sender=None):
+        self.held[key] = (release_at, sender, frame)
+
+    def unhold(self, key):
+        '''
+        return the frame held under key, which will now never be sent, or None.
+        '''
+        entry = self.held.pop(key, None)
+        if entry:
+            return entry[2]
+
+    def release(self, now=None):
+        '''
+        Queue the held frames that are due, oldest first.
+
+        return the number of frames ready to write.
+        '''
+        if self.held:
+            now = now or time.time()
+            due = sorted((entry for entry in self.held.items() if entry[1][0] <= now),
+                         key=lambda entry: entry[1][0])
+            for key, (_, sender, frame) in due:
+                del self.held[key]
+                self.append(frame, sender)
+        return self.length
+
+    def items(self):
+        '''
+        Yield (sender, frame) for every queued frame, sender being None for our own.
+        '''
+        for each_frame in self.system:
+            yield None, each_frame
+        for each_sender in self.turns:
+            for each_frame in self.senders[each_sender]:
+                yield each_sender, each_frame
+        for _, sender, each_frame in self.held.values():
+            yield sender, each_frame
+
+    def clear(self):
+        self.system.clear()
+        self.senders.clear()
+        self.turns.clear()
+        self.held.clear()
+        self.length = 0
+
+
+class OutboundSpool(object):
+    '''
+    Holds the messages that matter while we are not connected to Grapevine, so a
+    restart of the network does not silently lose them.
+
+    Only sign-ins, sign-outs, tells and chat are spooled, at most max_entries of them
+    with the oldest dropped first.  With path set each one is also appended to that file
+    as a line of JSON, so the spool survives a restart of our own.  Before the spool is
+    flushed it is compacted: a player who signed in and back out meanwhile is dropped
+    entirely, only a player's last sign-in or sign-out is kept, and chat older than
+    chat_ttl and tells older than tell_ttl seconds are expired.
+    '''
+    EVENTS = ("players/sign-in", "players/sign-out", "tells/send", "channels/send")
+
+    def __init__(self, max_entries=500, path=None, chat_ttl=120, tell_ttl=600):
+        super().__init__()
+        self.entries = collections.deque(maxlen=max_entries)
+        self.path = path
+        self.chat_ttl = chat_ttl
+        self.tell_ttl = tell_ttl
+        self.metrics = {"spooled": 0,
+                        "dropped": 0,
+                        "compacted": 0,
+                        "expired": 0,
+                        "flushed": 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def wants(self, frame):
+        return isinstance(frame, dict) and frame.get("event") in self.EVENTS
+
+    def add(self, frame, sender=None, spooled_at=None):
+        entry = [spooled_at or time.time(), sender, frame]
+        if len(self.entries) == self.entries.maxlen:
+            self.metrics["dropped"] += 1
+        self.entries.append(entry)
+        self.metrics["spooled"] += 1
+
+        if self.path:
+            try:
+                with open(self.path, "a") as spool_file:
+                    spool_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            except OSError:
+                pass
+
+    def load(self):
+        '''
+        Pick up what a previous run left in the spool file.
+        '''
+        if not self.path:
+            return
+        try:
+            with open(self.path) as spool_file:
+                for each_line in spool_file:
+                    try:
+                        self.entries.append(json.loads(each_line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+
+    def compact(self):
+        '''
+        Empty the spool.
+
+        return the (sender, frame) pairs still worth sending, oldest first.
+        '''
+        now = time.time()
+        ttls = {"channels/send": self.chat_ttl, "tells/send": self.tell_ttl}
+        presence = {}
+        kept = []
+
+        for spooled_at, sender, frame in self.entries:
+            event = frame["event"]
+            if event in ttls:
+                if now - spooled_at > ttls[event]:
+                    self.metrics["expired"] += 1
+                else:
+                    kept.append((sender, frame))
+                continue
+
+            name = frame["payload"]["name"]
+            if name in presence:
+                self.metrics["compacted"] += 1
+                presence[name][1] = (sender, frame)
+            else:
+                presence[name] = [event, (sender, frame)]
+
+        for first_event, (sender, frame) in presence.values():
+            if first_event == "players/sign-in" and frame["event"] == "players/sign-out":
+                self.metrics["compacted"] += 1
+                continue
+            kept.append((sender, frame))
+
+        self.clear()
+        self.metrics["flushed"] += len(kept)
+        return kept
+
+    def clear(self):
+        self.entries.clear()
+        if self.path:
+            try:
+                open(self.path, "w").close()
+            except OSError:
+                pass
+
+
+class SharedPlayerCache(object):
+    '''
+    The foreign player cache and game directory of one process, published through a
+    memory mapped file at path for other processes on the host to read.
+
+    The process holding the Grapevine connection creates it with owner=True and its
+    GrapevineSocket publishes whenever those caches change.  Every other process opens
+    the same path and calls players() and games(), with no connection or queries of its
+    own.  The file is a header (magic, format, sequence, length) followed by the body in
+    marshal format, so both sides must run the same Python version.
+
+    Readers take no lock.  The owner makes the sequence odd while it writes and even
+    again when done; a reader copies the body between two reads of the sequence and
+    retries if they differ or are odd.  A body it has already decoded is reused while
+    the sequence stays the same.  A body bigger than size is not published.
+
+    The file is never truncated, readers may have it mapped.  A restarted owner grows it
+    to size if needed and carries on from the sequence already in the header, so readers
+    see its first publish as new.
+    '''
+    MAGIC = b"GVPC"
+    FORMAT = 1
+    HEADER = struct.Struct("!4sIQQ")
+
+    def __init__(self, path, owner=False, size=4 * 1024 * 1024):
+        super().__init__()
+        self.path = path
+        self.owner = owner
+        self.sequence = None
+        self.data = {"players": {}, "games": [], "published_at": 0}
+        self.metrics = {"published": 0,
+                        "too_big": 0,
+                        "reads": 0,
+                        "decodes": 0,
+                        "retries": 0}
+
+        if owner:
+            with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as cache_file:
+                if os.fstat(cache_file.fileno()).st_size < size:
+                    cache_file.truncate(size)
+                self.map = mmap.mmap(cache_file.fileno(), 0)
+            magic, version, sequence, _ = self.HEADER.unpack_from(self.map)
+            if magic != self.MAGIC or version != self.FORMAT:
+                sequence = 0
+            # An odd sequence is a publish the last owner never finished.
+            sequence += sequence % 2
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.FORMAT, sequence, 0)
+        else:
+            self.map = None
+            self.map_reader()
+
+    def map_reader(self):
+        # Map the whole file read only, it may have grown since we last mapped it.
+        with open(self.path, "rb") as cache_file:
+            if os.fstat(cache_file.fileno()).st_size < self.HEADER.size:
+                raise ValueError(f"{self.path} is not a shared player cache yet")
+            shared_map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map is not None:
+            self.map.close()
+        self.map = shared_map
+
+    def publish(self, players, games):
+        '''
+        Replace the published cache.  Only the owner may publish.
+
+        return True if published.
+        '''
+        body = marshal.dumps({"players": players,
+                              "games": games,
+                              "published_at": time.time()})
+        if self.HEADER.size + len(body) > len(self.map):
+            self.metrics["too_big"] += 1
+            return False
+
+        _, _, sequence, _ = self.HEADER.unpack_from(self.map)
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.FORMAT, sequence + 1, 0)
+        self.map[self.HEADER.size:self.HEADER.size + len(body)] = body
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.FORMAT, sequence + 2, len(body))
+        self.metrics["published"] += 1
+        return True
+
+    def read(self, attempts=100):
+        '''
+        return the latest published {"players": ..., "games": ..., "published_at": ...},
+        or the last one read if the owner kept us waiting for all of attempts.
+        '''
+        self.metrics["reads"] += 1
+        for _ in range(attempts):
+            magic, version, sequence, length = self.HEADER.unpack_from(self.map)
+            if magic != self.MAGIC or version != self.FORMAT:
+                break
+            if sequence == self.sequence:
+                break
+            if sequence % 2:
+                self.metrics["retries"] += 1
+                continue
+            if self.HEADER.size + length > len(self.map):
+                self.map_reader()
+                continue
+            if not length:
+                # A new owner that has not published yet.
+                self.sequence = sequence
+                break
+            body = self.map[self.HEADER.size:self.HEADER.size + length]
+            if self.HEADER.unpack_from(self.map)[2] != sequence:
+                self.metrics["retries"] += 1
+                continue
+            self.data = marshal.loads(body)
+            self.sequence = sequence
+            self.metrics["decodes"] += 1
+            break
+        return self.data
+
+    def players(self):
+        '''
+        return the published other_games_players, {game: [player, ...]}.
+        '''
+        return self.read()["players"]
+
+    def games(self):
+        '''
+        return the published games/status payloads.
+        '''
+        return self.read()["games"]
+
+    def close(self):
+        self.map.close()
+
+
+class PerMessageDeflate(object):
+    '''
+    The permessage-deflate websocket extension (RFC 7692).
+
+    window_bits caps the compression window of the messages we send and
+    server_window_bits is asked of the server for the messages it sends.  Setting a
+    *_context_takeover to False compresses every message on its own, trading ratio for
+    the memory otherwise held between messages; it applies to our side and is asked of
+    the server respectively.  Messages shorter than min_size are sent uncompressed.
+    '''
+    TAIL = b"\x00\x00\xff\xff"
+
+    def __init__(self, window_bits=15, server_window_bits=15, client_context_takeover=True,
+                 server_context_takeover=True, level=6, min_size=64):
+        super().__init__()
+        self.window_bits = window_bits
+        self.server_window_bits = server_window_bits
+        self.client_context_takeover = client_context_takeover
+        self.server_context_takeover = server_context_takeover
+        self.level = level
+        self.min_size = min_size
+        self.active = {}
+        self.compressor = None
+        self.decompressor = None
+
+    def offer(self):
+        '''
+        return the Sec-WebSocket-Extensions value we send with the upgrade request.
+        '''
+        params = ["permessage-deflate", f"client_max_window_bits={self.window_bits}"]
+        if self.server_window_bits < 15:
+            params.append(f"server_max_window_bits={self.server_window_bits}")
+        if not self.client_context_takeover:
+            params.append("client_no_context_takeover")
+        if not self.server_context_takeover:
+            params.append("server_no_context_takeover")
+        return "; ".join(params)
+
+    def accept(self, response):
+        '''
+        Apply the parameters the server answered our offer with.  Raises ValueError if
+        the answer is not something we offered, which must fail the connection.
+        '''
+        active = {"window_bits": self.window_bits,
+                  "client_context_takeover": self.client_context_takeover,
+                  "server_context_takeover": self.server_context_takeover}
+
+        params = [each.strip() for each in response.split(";")]
+        if params[0] != "permessage-deflate" or "," in response:
+            raise ValueError(f"Unsupported websocket extension: {response}")
+        for each_param in params[1:]:
+            name, _, value = each_param.partition("=")
+            name = name.strip()
+            value = value.strip().strip('"')
+            if name == "server_no_context_takeover":
+                active["server_context_takeover"] = False
+            elif name == "client_no_context_takeover":
+                active["client_context_takeover"] = False
+            elif name == "client_max_window_bits" and value:
+                active["window_bits"] = min(active["window_bits"], int(value))
+            elif name != "server_max_window_bits":
+                raise ValueError(f"Unsupported permessage-deflate parameter: {name}")
+
+        # zlib cannot produce raw deflate with an 8 bit window, 9 is the smallest.
+        active["window_bits"] = max(9, active["window_bits"])
+        self.active = active
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, data):
+        '''
+        return data compressed as one message, with the trailing empty block removed.
+        '''
+        if self.compressor is None or not self.active["client_context_takeover"]:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                               -self.active["window_bits"])
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-4] if data.endswith(self.TAIL) else data
+
+    def decompress(self, data):
+        if self.decompressor is None or not self.active["server_context_takeover"]:
+            # A 15 bit window inflates anything the server may send.
+            self.decompressor = zlib.decompressobj(-15)
+        return self.decompressor.decompress(data) + self.decompressor.decompress(self.TAIL)
+
+
 class GrapevineReceivedMessage(object):
+    streaming = None
+    arrival = None
+
     def __init__(self, message, gsock):
         super().__init__()
-        # Short hand to convert JSON data to instance attributes.
-        # Not secure at all.  If you're worreid about it feel free to modify
-        # to your needs.
-        for eachkey, eachvalue in json.loads(message).items():
-            setattr(self, eachkey, eachvalue)
-
         # Point an instance attribute to the module level grapevine socket.
         # Used for adding to and removing refs as well as keeping the foreign player
         # cache in the gsocket up to date.
         self.gsock = gsock
-        
-        # When we receive a JSON message from grapevine it will always have an event type.
-        self.rcvr_func = {"heartbeat": (self.gsock.msg_gen_heartbeat, None),
-                          "authenticate": (self.received_auth, None),
-                          "restart": (self.received_restart, None),
-                          "channels/broadcast": (self.received_broadcast_message, None),
-                          "channels/subscribe": (self.received_chan_sub, gsock.sent_refs),
-                          "channels/unsubscribe": (self.received_chan_unsub, gsock.sent_refs),
-                          "players/sign-out": (self.received_player_logout, gsock.sent_refs),
-                          "players/sign-in": (self.received_player_login, gsock.sent_refs),
-                          "games/connect": (self.received_games_connected, None),
-                          "games/disconnect": (self.received_games_disconnected, None),
-                          "games/status": (self.received_games_status, gsock.sent_refs),
-                          "players/status": (self.received_player_status, gsock.sent_refs),
-                          "tells/send": (self.received_tells_status, gsock.sent_refs),
-                          "tells/receive": (self.received_tells_message, None),
-                          "channels/send": (self.received_message_confirm, gsock.sent_refs)}
 
+        # Sniff the event, ref and status first.  A frame the game has no interest in
+        # is left undecoded with skipped set, and parse_frame() ignores it.
+        self.skipped = False
+        header = {"event": sniff_field(message, "event"),
+                  "ref": sniff_field(message, "ref"),
+                  "status": sniff_field(message, "status")}
+        if not gsock.wants_frame(message, **header):
+            self.skipped = True
+            gsock.stats["frames_skipped"] += 1
+            for eachkey, eachvalue in header.items():
+                if eachvalue is not None:
+                    setattr(self, eachkey, eachvalue)
+            return
+
+        # Filled in by the handlers as the frame is dispatched, see GrapevineSocket.on().
+        self.result = None
+        self.handled = False
 
         self.restart_downtime = 0
 
+        # Player lists are numbered as they come in, so an older one still being
+        # streamed never replaces a newer one.  See received_player_status().
+        if header["event"] == "players/status":
+            gsock.status_arrivals += 1
+            self.arrival = gsock.status_arrivals
+
+        # A big enough players/status is not decoded in one go.  Its player list is
+        # parsed a slice at a time, see GrapevineSocket.stream_min_size, and the frame
+        # is dispatched once the whole list is in.
+        if (header["event"] == "players/status" and gsock.stream_min_size
+                and len(message) >= gsock.stream_min_size):
+            start = _players_start.search(message)
+            if start:
+                self.streaming = PlayerListStream(message, start.end())
+                gsock.stats["frames_streamed"] += 1
+                for eachkey, eachvalue in header.items():
+                    if eachvalue is not None:
+                        setattr(self, eachkey, eachvalue)
+                self.payload = {"game": sniff_field(message, "game"),
+                                "players": self.streaming.players}
+                return
+
+        # Short hand to convert JSON data to instance attributes.
+        # Not secure at all.  If you're worreid about it feel free to modify
+        # to your needs.
+        for eachkey, eachvalue in json.loads(message).items():
+            setattr(self, eachkey, eachvalue)
+
     def parse_frame(self):
         '''
             Parse any received JSON from the Grapevine network.
 
-            Verify we have an attribute from the JSON that is 'event'. If we have a key
-            in the rcvr_func that matches we will execute.
+            Verify we have an attribute from the JSON that is 'event', then run the
+            handlers registered on the GrapevineSocket for it.  Skipped frames do nothing.
+            A streamed frame with more of its player list to parse waits in the
+            GrapevineSocket's stream_queue and is dispatched from handle_read() later.
 
-            return whatever is returned by the method, or None.
+            return the result the handlers left, or None.
        '''
-        if hasattr(self, "event") and self.event in self.rcvr_func:
-            exec_func, args = self.rcvr_func[self.event]
-            if args == None:
-                retvalue = exec_func()
-            else:
-                retvalue = exec_func(args)
-                
-            if retvalue:
-                return retvalue
+        if self.skipped or not hasattr(self, "event"):
+            return
+
+        if self.streaming and not self.streaming.done:
+            self.streaming.step(self.gsock.stream_chunk)
+            if not self.streaming.done:
+                self.gsock.stream_queue.append(self)
+                return
+            if self.streaming.error:
+                self.gsock.stream_failed(self)
+                return
+
+        retvalue = self.gsock.dispatch(self)
+        if retvalue:
+            return retvalue
+
+    def received_heartbeat(self):
+        '''
+        Grapevine is checking on us, answer with our heartbeat.
+        '''
+        self.gsock.msg_gen_heartbeat()
 
     def is_event_status(self, status):
         '''
@@ -157,13 +1457,15 @@ class GrapevineReceivedMessage(object):
             self.gsock.state["authenticated"] = True
             self.gsock.state["connected"] = True
             self.gsock.msg_gen_chan_subscribe()
+            self.gsock.msg_gen_roster_sync()
             # The below line is Akrios Specific.
             # XXX
             #comm.wiznet("Received authentication success from Grapevine.")
-            self.gsock.msg_gen_player_status_query()
+            self.gsock.refresh_player_status()
+            self.gsock.flush_spool()
             # The below line is Akrios specific.
             # XXX
-            #comm.wiznet("Sending player status query to all Grapevine games.")
+            #comm.wiznet("Sending player status query to Grapevine games.")
         elif self.gsock.state["authenticated"] == False:
             # The below line is Akrios specific.
             # XXX
@@ -180,7 +1482,7 @@ class GrapevineReceivedMessage(object):
         if hasattr(self, "payload"):
             self.restart_downtime = int(self.payload["downtime"])
 
-    def received_chan_sub(self, sent_refs):
+    def received_chan_sub(self):
         '''
         We have attempted to subscribe to a channel.  This is a response message from Grapevine.
         If failure, we make sure we show unsubbed in our local list.
@@ -188,30 +1490,32 @@ class GrapevineReceivedMessage(object):
 
         return None
         '''
+        sent_refs = self.gsock.sent_refs
         if hasattr(self, "ref") and self.ref in sent_refs:
             orig_req = sent_refs.pop(self.ref)
             if self.is_event_status("failure"):
                 channel = orig_req["payload"]["channel"]
                 self.gsock.subscribed[channel] = False
                 if self.gsock.debug:
-                    print(f"Failed to subscribe to channel {channel}")
+                    self.gsock.debug_logger().log("subscribe_failed", channel=channel)
             elif self.is_event_status("success"):
                 channel = orig_req["payload"]["channel"]
                 self.gsock.subscribed[channel] = True
 
-    def received_chan_unsub(self, sent_refs):
+    def received_chan_unsub(self):
         '''
         We at some point sent a channel unsubscribe. This is verifying Grapevine
         received that.  We unsub in our local list.
 
         return None
         '''
+        sent_refs = self.gsock.sent_refs
         if hasattr(self, "ref") and self.ref in sent_refs:
             orig_req = sent_refs.pop(self.ref)
             channel = orig_req["payload"]["channel"]
             self.gsock.subscribed[channel] = False
 
-    def received_player_logout(self, sent_refs):
+    def received_player_logout(self):
         '''
         We have received a "player/sign-out" message from Grapevine.
 
@@ -221,6 +1525,7 @@ class GrapevineReceivedMessage(object):
 
         return None if it's an ack from grapevine, return player info if it's foreign.
         '''
+        sent_refs = self.gsock.sent_refs
         if hasattr(self, "ref"):
             # We are a success message from Grapevine returned from our notification.
             if self.ref in sent_refs and self.is_event_status("success"):
@@ -228,8 +1533,11 @@ class GrapevineReceivedMessage(object):
                 return
             # We are receiving a player logout from another game.
             if "game" in self.payload:
-                game = self.payload["game"].capitalize()
+                game = game_key(self.payload["game"])
+                self.gsock.game_names[game] = self.payload["game"]
                 player = self.payload["name"].capitalize()
+                for each_msg in self.gsock.streams_for(game):
+                    each_msg.streaming.changes.append((False, player))
                 if game in self.gsock.other_games_players:
                     if player in self.gsock.other_games_players[game]:
                         self.gsock.other_games_players[game].remove(player)
@@ -238,7 +1546,7 @@ class GrapevineReceivedMessage(object):
 
                 return (player, "signed out of", game)
 
-    def received_player_login(self, sent_refs):
+    def received_player_login(self):
         '''
         We have received a "player/sign-in" message from Grapevine.
 
@@ -248,14 +1556,18 @@ class GrapevineReceivedMessage(object):
 
         return None if it's an ack from grapevine, return player info if it's foreign
         '''
+        sent_refs = self.gsock.sent_refs
         if hasattr(self, "ref"):
             # We are a success message from Grapevine returned from our notification.
             if self.ref in sent_refs and self.is_event_status("success"):
                 orig_req = sent_refs.pop(self.ref)
                 return
             if "game" in self.payload:
-                game = self.payload["game"].capitalize()
+                game = game_key(self.payload["game"])
+                self.gsock.game_names[game] = self.payload["game"]
                 player = self.payload["name"].capitalize()
+                for each_msg in self.gsock.streams_for(game):
+                    each_msg.streaming.changes.append((True, player))
                 if game in self.gsock.other_games_players:
                     if player not in self.gsock.other_games_players[game]:
                         self.gsock.other_games_players[game].append(player)
@@ -265,152 +1577,797 @@ class GrapevineReceivedMessage(object):
 
                 return (player, "signed into", game)
 
-    def received_player_status(self, sent_refs):
+    def received_player_status(self):
         '''
         We have requested a multi-game or single game status update.
         This is the response. We pop the valid Ref from our local list
-        and add them to the local cache.
+        and add them to the local cache.  A failure means the single game
+        we asked about is gone, so it is dropped from the cache.
 
         return None
         '''
+        sent_refs = self.gsock.sent_refs
+        if hasattr(self, "ref") and self.is_event_status("failure"):
+            orig_req = sent_refs.pop(self.ref, None)
+            if orig_req and "payload" in orig_req:
+                game = game_key(orig_req["payload"]["game"])
+                self.gsock.other_games_players.pop(game, None)
+                self.gsock.stale_games.discard(game)
+            return
+
         if hasattr(self, "ref") and hasattr(self, "payload"):
             # On first receive we pop the ref just so it's gone from the queue
             if self.ref in sent_refs:
                 orig_req = sent_refs.pop(self.ref)
-            game = self.payload["game"].capitalize()
+            game = game_key(self.payload["game"])
+            self.gsock.game_names[game] = self.payload["game"]
+            self.gsock.stale_games.discard(game)
+            self.gsock.status_queries.refreshed(game)
 
-            if len(self.payload["players"]) == 1 and self.payload["players"] in ["", None]:
-                self.gsock.other_games_players[game] = []
-                return
-            if len(self.payload["players"]) == 1:
-                player = self.payload["players"][0].capitalize()
-                self.gsock.other_games_players[game] = []
-                self.gsock.other_games_players[game].append(player)
-                return
-            if len(self.payload["players"]) > 1:
-                player = [player.capitalize() for player in self.payload["players"]]
-                self.gsock.other_games_players[game] = []
-                self.gsock.other_games_players[game] = player
-                return
+            # A list older than the one already in the cache is dropped, as are lists for
+            # the game that came in before this one and are still being parsed.
+            applied = self.gsock.list_arrivals.get(game)
+            if self.arrival is not None:
+                if applied is not None and applied > self.arrival:
+                    return
+                self.gsock.list_arrivals[game] = self.arrival
+                for each_msg in self.gsock.streams_for(game):
+                    if each_msg.arrival < self.arrival:
+                        self.gsock.stream_queue.remove(each_msg)
 
-    def received_tells_status(self, sent_refs):
+            # A streamed list was capitalized as it was parsed and is swapped in whole,
+            # then the sign-ins and sign-outs that came in while it was parsed are
+            # applied.
+            players = self.payload["players"]
+            if not self.streaming:
+                players = [player.capitalize() for player in players if player]
+            else:
+                for signed_in, player in self.streaming.changes:
+                    if signed_in and player not in players:
+                        players.append(player)
+                    elif not signed_in and player in players:
+                        players.remove(player)
+            self.gsock.other_games_players[game] = players
+
+    def received_tells_status(self):
         '''
-        One of the local players has sent a tell.  This is specific response of an error
-        Provide the error and other pertinent info to the local game for handling
-        as required.
+        One of the local players has sent a tell.  Every answer retires its ref, and for
+        an error we provide the error and other pertinent info to the local game for
+        handling as required.
         '''
+        sent_refs = self.gsock.sent_refs
         if hasattr(self, "ref"):
-            if self.ref in sent_refs and hasattr(self, "error"):
+            if self.ref in sent_refs:
                 orig_req = sent_refs.pop(self.ref)
-                if self.is_event_status("failure"):
+                if self.is_event_status("failure") and hasattr(self, "error"):
                     caller = orig_req["payload"]['from_name'].capitalize()
                     target = orig_req["payload"]['to_name'].capitalize()
                     game = orig_req["payload"]['to_game'].capitalize()
                     return (caller, target, game, self.error)
 
-    def received_tells_message(self):
+    def received_tells_message(self):
+        '''
+        We have received a tell message destined for a player in our game.
+        Grab the details and return to the local game to handle as required.
+        '''
+        if hasattr(self, "ref") and hasattr(self, "payload"):
+            sender = self.payload['from_name']
+            target = self.payload['to_name']
+            game = self.payload['from_game']
+            sent = self.payload['sent_at']
+            message = self.payload['message']
+                
+            return (sender, target, game, sent, message)
+
+    def received_games_status(self):
+        '''
+        Received a game status response.  The game directory cache is updated,
+        then the received info is returned to the local game to handle as required
+        if we asked for it.  Not using this in Akrios at the moment.
+
+        Every game answers an all games query with the same ref, so that ref stays in
+        sent_refs until the next all games query replaces it.
+        '''
+        sent_refs = self.gsock.sent_refs
+        if hasattr(self, "ref") and hasattr(self, "payload") and self.is_event_status("success"):
+            self.gsock.game_directory.store(self.payload)
+            orig_req = sent_refs.get(self.ref)
+            if orig_req:
+                if "payload" in orig_req:
+                    sent_refs.pop(self.ref)
+                game = self.payload['game']
+                display_name = self.payload['display_name']
+                description = self.payload['description']
+                homepage = self.payload['homepage_url']
+                user_agent = self.payload['user_agent']
+                user_agent_repo = self.payload['user_agent_repo_url']
+                connections = self.payload['connections']
+
+                supports = self.payload['supports']
+                num_players = self.payload['players_online_count']
+
+                return(game, display_name, description, homepage, user_agent,
+                       user_agent_repo, connections, supports, num_players)
+
+        if hasattr(self, "ref") and hasattr(self, "error") and self.is_event_status("failure"):
+            orig_req = sent_refs.pop(self.ref, None)
+            if orig_req and "payload" in orig_req:
+                game = orig_req["payload"]["game"]
+                self.gsock.game_directory.failed(game)
+                return (game, self.error)
+
+    def received_message_confirm(self):
+        '''
+        We received a confirmation that Grapevine received an outbound broadcase message
+        from us.  Nothing to see here other than removing from our sent references list.
+        '''
+        sent_refs = self.gsock.sent_refs
+        if hasattr(self, "ref"):
+            if self.ref in sent_refs and self.is_event_status("success"):
+                orig_req = sent_refs.pop(self.ref) 
+
+    def is_other_game_player_update(self):
+        '''
+        A helper method to determine if this is a player update from another game.
+        '''
+        if hasattr(self, "event"):
+            if self.event == "players/sign-in" or self.event == "players/sign-out":
+                if hasattr(self, "payload") and 'game' in self.payload:
+                    return True
+            else:
+                return False
+
+    def received_games_connected(self):
+        '''
+        A foreign game has connected to the network, add the game to our local
+        cache of games/players and send a request for its player list.
+        '''
+        if hasattr(self, "payload"):
+            # Clear what we knew about this game and request an update from just that
+            # game.  The other games are unaffected by it connecting, and the coalescer
+            # keeps a game that flaps from being queried over and over.
+            game = game_key(self.payload["game"])
+            self.gsock.game_names[game] = self.payload["game"]
+            if self.gsock.msg_gen_player_single_status_query(self.payload["game"]):
+                self.gsock.other_games_players[game] = []
+            return self.payload["game"]
+
+    def received_games_disconnected(self):
+        '''
+        A foreign game has disconnected, remove it from our local cache and return
+        details to local game to handle as required.
+        '''
+        if hasattr(self, "payload"):
+            game = game_key(self.payload["game"])
+            self.gsock.other_games_players.pop(game, None)
+            self.gsock.game_names.pop(game, None)
+            self.gsock.status_queries.forget(game)
+            self.gsock.stale_games.discard(game)
+            self.gsock.game_directory.evict(self.payload["game"])
+            return self.payload["game"]
+
+    def received_broadcast_message(self):
+        '''
+        We received a broadcast message from another game.  It is kept in the channel
+        history, then we return the pertinent info so the local game can handle as
+        required.  See examples above.
+        '''
+        if hasattr(self, "payload"):
+            self.gsock.channel_history.add(self.payload.get("channel"), self.payload['name'],
+                                           self.payload['game'], self.payload['message'])
+            return (self.payload['name'], self.payload['game'], self.payload['message'])
+
+
+class SyntheticMessage(GrapevineReceivedMessage):
+    '''
+    An event that did not come off the wire, like the "players/digest" events the
+    client makes up itself.  It is built already decoded from attrs, a dict of the
+    attributes a decoded frame would have, so parse_frame() only runs the handlers.
+    '''
+    def __init__(self, attrs, gsock):
+        self.gsock = gsock
+        self.skipped = False
+        self.handled = False
+        self.result = None
+        self.restart_downtime = 0
+        for eachkey, eachvalue in attrs.items():
+            setattr(self, eachkey, eachvalue)
+
+
+class DebugLog(object):
+    '''
+    Structured debug log, cheap enough to leave on with a busy connection.
+
+    log() and frame() only add a record to a ring buffer of capacity records, a
+    background thread writes them out as JSON lines every interval seconds.  When the
+    writer falls behind the oldest records are dropped and counted, the game loop never
+    waits on the output.  Call flush() to write out what is buffered now, close() to
+    stop the thread.
+
+    sample maps an event to N, keeping only 1 in N of its frames, by default 1 in 100
+    heartbeats.  Frame text is cut to max_text characters, and the values of the keys
+    in redact are masked as they are written.
+    '''
+    def __init__(self, stream=None, capacity=10000, interval=1.0, sample=None, max_text=1024,
+                 redact=("client_secret",)):
+        super().__init__()
+        # The below is where records are written, sys.stdout when None.  Replace with
+        # an open log file if you like.
+        # XXX
+        self.stream = stream
+        self.records = collections.deque(maxlen=capacity)
+        self.interval = interval
+        self.sample = {"heartbeat": 100} if sample is None else dict(sample)
+        self.sample_counts = collections.Counter()
+        self.max_text = max_text
+        self.redact = None
+        if redact:
+            keys = "|".join(re.escape(each_key) for each_key in redact)
+            self.redact = re.compile(rf'("(?:{keys})"\s*:\s*")[^"]*')
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.writer = None
+        self.metrics = {"logged": 0,
+                        "sampled_out": 0,
+                        "truncated": 0,
+                        "dropped": 0,
+                        "written": 0,
+                        "write_errors": 0}
+
+    def log(self, kind, **fields):
+        '''
+        Buffer a record of kind with fields, which must be JSON serializable.
+        '''
+        if self.writer is None:
+            self.closed = False
+            self.writer = threading.Thread(target=self.run, name="grapevine-debug-log",
+                                           daemon=True)
+            self.writer.start()
+        if len(self.records) == self.records.maxlen:
+            self.metrics["dropped"] += 1
+        self.records.append((time.time(), kind, fields))
+        self.metrics["logged"] += 1
+
+    def frame(self, kind, text):
+        '''
+        Buffer the text of a frame sent or received, subject to sampling by its event.
+
+        return False if the frame was sampled out.
+        '''
+        event = sniff_field(text, "event")
+        every = self.sample.get(event)
+        if every and every > 1:
+            self.sample_counts[event] += 1
+            if self.sample_counts[event] % every != 1:
+                self.metrics["sampled_out"] += 1
+                return False
+
+        fields = {"event": event, "text": text}
+        if len(text) > self.max_text:
+            fields["text"] = text[:self.max_text]
+            fields["length"] = len(text)
+            self.metrics["truncated"] += 1
+        self.log(kind, **fields)
+        return True
+
+    def run(self):
+        # The writer thread.
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        '''
+        Write out every buffered record.
+
+        return the number of records written.
+        '''
+        with self.write_lock:
+            lines = []
+            while self.records:
+                stamp, kind, fields = self.records.popleft()
+                if self.redact and "text" in fields:
+                    fields["text"] = self.redact.sub(r"\1***", fields["text"])
+                record = {"time": round(stamp, 3), "kind": kind}
+                record.update(fields)
+                lines.append(json.dumps(record, default=repr))
+            if not lines:
+                return 0
+
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except (OSError, ValueError):
+                self.metrics["write_errors"] += 1
+                return 0
+            self.metrics["written"] += len(lines)
+            return len(lines)
+
+    def close(self):
+        '''
+        Stop the writer thread, writing out whatever is left first.  The next record
+        starts it again.
+        '''
+        self.closed = True
+        self.wake.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        self.flush()
+
+
+class HandlerWatchdog(object):
+    '''
+    Times every handler the client dispatches.
+
+    A call taking longer than budget seconds is passed to log and kept in slow_calls
+    along with its event and a stack sample, and slowest() reports the handlers with
+    the worst times.  While a handler runs a sampler thread checks on it every
+    budget / 2 seconds, and once it is over budget captures the stack of the thread
+    running it, so the sample shows where the handler was stuck.  Without a sample the
+    stack of the dispatch is kept instead.
+    '''
+    def __init__(self, budget=0.05, keep=50, stack_depth=12):
+        super().__init__()
+        self.budget = budget
+        self.stack_depth = stack_depth
+        self.slow_calls = collections.deque(maxlen=keep)
+        self.totals = {}
+        self.current = None
+        self.active = threading.Event()
+        self.sampler = None
+        self.stopped = False
+        # The below is passed a report of each slow call, the client points it at its
+        # debug log.  Replace with your own logging if you like.
+        # XXX
+        #self.log = comm.wiznet
+        self.log = None
+
+    def call(self, event, handler, *args):
+        '''
+        Run handler(*args) for event, timing it.
+
+        return whatever the handler returns.
+        '''
+        if self.sampler is None:
+            self.stopped = False
+            self.sampler = threading.Thread(target=self.sample, name="grapevine-watchdog",
+                                            daemon=True)
+            self.sampler.start()
+
+        name = getattr(handler, "__qualname__", repr(handler))
+        previous = self.current
+        started = time.perf_counter()
+        self.current = [name, event, started, threading.get_ident(), None]
+        self.active.set()
+        try:
+            return handler(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            current = self.current
+            self.current = previous
+            if previous is None:
+                self.active.clear()
+            self.record(name, event, elapsed, current[4])
+
+    def record(self, name, event, elapsed, stack):
+        totals = self.totals.get((event, name))
+        if totals is None:
+            totals = self.totals[(event, name)] = {"handler": name,
+                                                   "event": event,
+                                                   "calls": 0,
+                                                   "seconds": 0.0,
+                                                   "worst": 0.0,
+                                                   "slow": 0}
+        totals["calls"] += 1
+        totals["seconds"] += elapsed
+        totals["worst"] = max(totals["worst"], elapsed)
+        if elapsed <= self.budget:
+            return
+
+        totals["slow"] += 1
+        if stack is None:
+            stack = "".join(traceback.format_stack(limit=self.stack_depth)[:-2])
+        self.slow_calls.append({"handler": name,
+                                "event": event,
+                                "seconds": elapsed,
+                                "at": time.time(),
+                                "stack": stack})
+        if self.log:
+            self.log(f"Grapevine handler {name} for {event} took {elapsed * 1000:.1f}ms, "
+                     f"over the {self.budget * 1000:.0f}ms budget:\n{stack}")
+
+    def sample(self):
+        while not self.stopped:
+            self.active.wait()
+            time.sleep(self.budget / 2)
+            current = self.current
+            if current is None or current[4] is not None:
+                continue
+            if time.perf_counter() - current[2] > self.budget:
+                frame = sys._current_frames().get(current[3])
+                if frame is not None:
+                    current[4] = "".join(traceback.format_stack(frame, limit=self.stack_depth))
+
+    def close(self):
+        '''
+        Stop the sampler thread.  The next call starts it again.
+        '''
+        if self.sampler is None:
+            return
+        self.stopped = True
+        self.active.set()
+        self.sampler.join()
+        self.sampler = None
+        if self.current is None:
+            self.active.clear()
+
+    def slowest(self, count=10):
+        '''
+        return the timing totals of the count handlers with the worst single call.
+        '''
+        return sorted(self.totals.values(), key=lambda totals: totals["worst"],
+                      reverse=True)[:count]
+
+
+def offload_key(rcvd_msg):
+    '''
+    The default ordering key of a blocking handler call: the channel of chat, the
+    sending player of tells and sign-ins, otherwise the event.
+    '''
+    payload = getattr(rcvd_msg, "payload", None)
+    if not isinstance(payload, dict):
+        return ("event", rcvd_msg.event)
+    if "channel" in payload:
+        return ("channel", payload["channel"])
+    name = payload.get("from_name") or payload.get("name")
+    if name:
+        return ("player", payload.get("from_game") or payload.get("game"), name)
+    return ("event", rcvd_msg.event)
+
+
+class HandlerPool(object):
+    '''
+    Runs blocking handlers on a pool of max_workers threads so they do not hold up the
+    game loop.
+
+    Calls with the same key run one at a time in the order they were submitted, calls
+    with different keys run side by side.  At most max_pending calls wait or run at once,
+    anything more is dropped and counted.  What a call returns, or the error it raised,
+    goes on a completion queue that run_completed() empties on the game's own thread.
+    '''
+    def __init__(self, max_workers=4, max_pending=1000):
+        super().__init__()
+        self.max_workers = max_workers
+        self.executor = None
+        self.max_pending = max_pending
+        self.pending = 0
+        self.chains = {}
+        self.lock = threading.Lock()
+        self.completed = collections.deque()
+        self.metrics = {"submitted": 0,
+                        "completed": 0,
+                        "failed": 0,
+                        "dropped": 0}
+
+        # The below is passed a report of each failed call, the client points it at its
+        # debug log.  Replace with your own logging if you like.
+        # XXX
+        #self.log = comm.wiznet
+        self.log = None
+
+    def submit(self, key, handler, rcvd_msg, done=None):
+        '''
+        Queue handler(rcvd_msg) behind any other call with key.
+
+        return False if dropped for being over max_pending.
+        '''
+        job = (handler, rcvd_msg, done)
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.metrics["dropped"] += 1
+                return False
+            self.pending += 1
+            self.metrics["submitted"] += 1
+            if key in self.chains:
+                self.chains[key].append(job)
+                return True
+            self.chains[key] = collections.deque()
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="grapevine-handler")
+        self.executor.submit(self.run_chain, key, job)
+        return True
+
+    def run_chain(self, key, job):
+        # Runs on a pool thread, working through the calls queued for key.
+        while True:
+            handler, rcvd_msg, done = job
+            try:
+                self.completed.append((handler, rcvd_msg, done, handler(rcvd_msg), None))
+            except Exception:
+                self.completed.append((handler, rcvd_msg, done, None, traceback.format_exc()))
+
+            with self.lock:
+                self.pending -= 1
+                chain = self.chains[key]
+                if not chain:
+                    del self.chains[key]
+                    return
+                job = chain.popleft()
+
+    def run_completed(self):
+        '''
+        Hand finished calls back on the calling thread: done(rcvd_msg, result) for those
+        that gave a done callback, a log line for those that failed.
+
+        return the number of calls handled.
+        '''
+        count = 0
+        while self.completed:
+            handler, rcvd_msg, done, result, error = self.completed.popleft()
+            count += 1
+            if error:
+                self.metrics["failed"] += 1
+                if self.log:
+                    name = getattr(handler, "__qualname__", repr(handler))
+                    self.log(f"Grapevine handler {name} for {rcvd_msg.event} failed:\n{error}")
+                continue
+            self.metrics["completed"] += 1
+            if done:
+                done(rcvd_msg, result)
+        return count
+
+    def shutdown(self, wait=True):
+        '''
+        Stop the worker threads once the calls already submitted are done.  The next
+        submit() starts new ones.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown(wait)
+            self.executor = None
+
+
+class OffloadedHandler(object):
+    '''
+    Stands in for a blocking handler in the handler lists, passing each call to the
+    registry's HandlerPool.
+    '''
+    def __init__(self, registry, handler, key=None, done=None):
+        super().__init__()
+        self.registry = registry
+        self.handler = handler
+        self.key = key or offload_key
+        self.done = done
+        self.__qualname__ = f"{getattr(handler, '__qualname__', repr(handler))} (offloaded)"
+
+    def __call__(self, rcvd_msg):
+        self.registry.offload(self, rcvd_msg)
+
+
+# The client's own handler for each event, run at CORE_PRIORITY so that handlers of
+# your own see the caches already updated and the result filled in.
+CORE_PRIORITY = 100
+CORE_HANDLERS = {"heartbeat": GrapevineReceivedMessage.received_heartbeat,
+                 "authenticate": GrapevineReceivedMessage.received_auth,
+                 "restart": GrapevineReceivedMessage.received_restart,
+                 "channels/broadcast": GrapevineReceivedMessage.received_broadcast_message,
+                 "channels/subscribe": GrapevineReceivedMessage.received_chan_sub,
+                 "channels/unsubscribe": GrapevineReceivedMessage.received_chan_unsub,
+                 "players/sign-out": GrapevineReceivedMessage.received_player_logout,
+                 "players/sign-in": GrapevineReceivedMessage.received_player_login,
+                 "games/connect": GrapevineReceivedMessage.received_games_connected,
+                 "games/disconnect": GrapevineReceivedMessage.received_games_disconnected,
+                 "games/status": GrapevineReceivedMessage.received_games_status,
+                 "players/status": GrapevineReceivedMessage.received_player_status,
+                 "tells/send": GrapevineReceivedMessage.received_tells_status,
+                 "tells/receive": GrapevineReceivedMessage.received_tells_message,
+                 "channels/send": GrapevineReceivedMessage.received_message_confirm}
+
+
+# The events whose core handlers change other_games_players or the game directory.
+SHARED_CACHE_EVENTS = {"players/sign-in", "players/sign-out", "players/status",
+                       "games/connect", "games/disconnect", "games/status"}
+
+
+class HandlerRegistry(object):
+    '''
+    The handlers run for each inbound event, shared by GrapevineSocket and the game side
+    of gateway mode.  Each event maps to a list of (priority, sequence, handler) kept
+    sorted, so dispatch is one dict lookup however many events are handled.
+    '''
+    def init_handlers(self, core_handlers=None):
+        self.handlers = {}
+        self._handler_sequence = 0
+        # The below times every handler call and reports the slow ones, see
+        # watchdog.slowest() and watchdog.slow_calls.  Set it to None to turn it off.
+        self.watchdog = HandlerWatchdog()
+        self.watchdog.log = self.debug_line
+        # The below runs handlers added with blocking=True.  It is started with
+        # offload_workers threads when the first one is added.
+        self.handler_pool = None
+        self.offload_workers = 4
+        # Set by digest_presence().
+        self.presence_digest = None
+        # The below is where debug records go while debug is set, see debug_logger().
+        self.debug_log = None
+        for event, handler in (core_handlers or {}).items():
+            self.handlers[event] = [(-CORE_PRIORITY, 0, handler)]
+
+    def debug_logger(self):
         '''
-        We have received a tell message destined for a player in our game.
-        Grab the details and return to the local game to handle as required.
+        return the DebugLog, a default one is made on first use.  To change the
+        sampling, output and so on assign your own DebugLog to debug_log.
         '''
-        if hasattr(self, "ref") and hasattr(self, "payload"):
-            sender = self.payload['from_name']
-            target = self.payload['to_name']
-            game = self.payload['from_game']
-            sent = self.payload['sent_at']
-            message = self.payload['message']
-                
-            return (sender, target, game, sent, message)
+        if self.debug_log is None:
+            self.debug_log = DebugLog()
+        return self.debug_log
 
-    def received_games_status(self, sent_refs):
+    def debug_line(self, text):
         '''
-        Received a game status response.  Return the received info to the local
-        game to handle as required.  Not using this in Akrios at the moment.
+        Log text to the debug log while debug is set.  The watchdog and handler pool
+        report through this.
         '''
-        if hasattr(self, "ref") and hasattr(self, "payload") and self.is_event_status("success"):
-            orig_req = sent_refs.pop(self.ref)
-            if self.ref in sent_refs:
-                game = self.payload['game']
-                display_name = self.payload['display_name']
-                description = self.payload['description']
-                homepage = self.payload['homepage_url']
-                user_agent = self.payload['user_agent']
-                user_agent_repo = self.payload['user_agent_repo_url']
-                connections = self.payload['connections']
+        if self.debug:
+            self.debug_logger().log("report", text=text)
 
-                supports = self.payload['supports']
-                num_players = self.payload['players_online_count']
+    def stop_threads(self):
+        '''
+        Stop the threads of the watchdog, the handler pool and the debug log, which all
+        start again when next needed.  gsocket_disconnect() calls this, so a client that
+        is thrown away leaves no threads behind.
+        '''
+        if self.watchdog:
+            self.watchdog.close()
+        if self.handler_pool:
+            self.handler_pool.shutdown(False)
+        if self.debug_log:
+            self.debug_log.close()
 
-                return(game, display_name, description, homepage, user_agent,
-                       user_agent_repo, connections, supports, num_players)
+    def on(self, event, priority=0, blocking=False, key=None, done=None):
+        '''
+        Decorator attaching a handler for an inbound event, for example
 
-        if hasattr(self, "ref") and hasattr(self, "error") and self.is_event_status("failure"):
-            orig_req = sent_refs.pop(self.ref)
-            if self.ref in sent_refs:
-                game = orig_req["payload"]["game"]
-                return (game, self.error)
+            @gsocket.on("tells/receive")
+            def tell_received(rcvd_msg):
+                sender, target, game, sent, message = rcvd_msg.result
 
-    def received_message_confirm(self, sent_refs):
+        Handlers are called with the GrapevineReceivedMessage, highest priority first
+        and in the order they were added within a priority.  The client's own handlers
+        run at CORE_PRIORITY and leave what they return in rcvd_msg.result.  Any handler
+        returning something other than None replaces result, and setting
+        rcvd_msg.handled to True stops the handlers after it.
+
+        A handler that blocks, on a database or a remote service, should say so with
+        blocking=True.  It then runs on handler_pool and the handlers after it do not
+        wait for it.  Calls with the same key(rcvd_msg), by default the channel or the
+        sending player, run in order.  Its return value goes to done(rcvd_msg, result)
+        back on the game's thread, from handle_read().  Leave the client's caches alone
+        from a blocking handler.
         '''
-        We received a confirmation that Grapevine received an outbound broadcase message
-        from us.  Nothing to see here other than removing from our sent references list.
+        def decorator(handler):
+            self.add_handler(event, handler, priority, blocking, key, done)
+            return handler
+        return decorator
+
+    def add_handler(self, event, handler, priority=0, blocking=False, key=None, done=None):
         '''
-        if hasattr(self, "ref"):
-            if self.ref in sent_refs and self.is_event_status("success"):
-                orig_req = sent_refs.pop(self.ref) 
+        Attach handler to event, see on().  Frames for the event are decoded from then on.
+        '''
+        if blocking:
+            handler = OffloadedHandler(self, handler, key, done)
+            if self.handler_pool is None:
+                self.handler_pool = HandlerPool(self.offload_workers)
+                self.handler_pool.log = self.debug_line
+        self._handler_sequence += 1
+        handlers = self.handlers.setdefault(event, [])
+        handlers.append((-priority, self._handler_sequence, handler))
+        handlers.sort(key=lambda entry: entry[:2])
+        self.interested_events.add(event)
 
-    def is_other_game_player_update(self):
+    def remove_handler(self, event, handler):
         '''
-        A helper method to determine if this is a player update from another game.
+        Detach handler from event.  Removing a CORE_HANDLERS entry turns off the
+        client's own behavior for that event.
         '''
-        if hasattr(self, "event"):
-            if self.event == "players/sign-in" or self.event == "players/sign-out":
-                if hasattr(self, "payload") and 'game' in self.payload:
-                    return True
-            else:
-                return False
+        self.handlers[event] = [entry for entry in self.handlers.get(event, [])
+                                if getattr(entry[2], "handler", entry[2]) != handler]
 
-    def received_games_connected(self):
+    def process_pending(self):
         '''
-        A foreign game has connected to the network, add the game to our local
-        cache of games/players and send a request for player list.
+        Handle every frame waiting in inbound_frame_buffer in one go, then announce the
+        presence digests that are due.  Call this once per pulse in place of taking
+        one frame at a time with receive_message().  Each frame still updates the
+        caches through its own handler as it is handled, it is the game's notifications
+        that are batched, see digest_presence().
+
+        return the number of frames handled.
         '''
-        if hasattr(self, "payload"):
-            # Clear what we knew about this game and request an update.
-            # Requesting updates from all games at this point, might as well refresh
-            # as I'm sure some games don't implement all features like player sign-in
-            # and sign-outs.
-            self.gsock.other_games_players[self.payload["game"]] = []
-            self.gsock.msg_gen_player_status_query()
-            return self.payload["game"]
+        count = 0
+        while self.inbound_frame_buffer:
+            self.receive_message().parse_frame()
+            count += 1
+        self.flush_presence_digests()
+        return count
 
-    def received_games_disconnected(self):
+    def digest_presence(self, window=5):
         '''
-        A foreign game has disconnected, remove it from our local cache and return
-        details to local game to handle as required.
+        Collect other games' sign-ins and sign-outs into one "players/digest" event per
+        game every window seconds, instead of running the game's players/sign-in and
+        players/sign-out handlers for each of them.  A digest's payload is
+        {"game": ..., "signed_in": [...], "signed_out": [...]}.  Digests go out from
+        process_pending().
         '''
-        if hasattr(self, "payload"):
-            if self.payload["game"] in self.gsock.other_games_players:
-                self.gsock.other_games_players.pop(self.payload["game"])
-            return self.payload["game"]
+        self.presence_digest = PresenceDigest(window)
+        for each_event in ("players/sign-in", "players/sign-out"):
+            self.remove_handler(each_event, self.collect_presence)
+            self.add_handler(each_event, self.collect_presence, CORE_PRIORITY - 1)
 
-    def received_broadcast_message(self):
+    def collect_presence(self, rcvd_msg):
+        # Runs right after the client's own handler, so the cache is already updated.
+        if not rcvd_msg.result or not rcvd_msg.is_other_game_player_update():
+            return
+        name, inout, game = rcvd_msg.result
+        self.presence_digest.add(game, name, inout == "signed into")
+        rcvd_msg.handled = True
+
+    def flush_presence_digests(self):
+        if not self.presence_digest:
+            return
+        for game, signed_in, signed_out in self.presence_digest.due():
+            SyntheticMessage({"event": "players/digest",
+                              "payload": {"game": game,
+                                          "signed_in": signed_in,
+                                          "signed_out": signed_out}}, self).parse_frame()
+
+    def offload(self, offloaded, rcvd_msg):
+        self.handler_pool.submit(offloaded.key(rcvd_msg), offloaded.handler, rcvd_msg,
+                                 offloaded.done)
+
+    def run_completed(self):
         '''
-        We received a broadcast message from another game.  Return the pertinent
-        info so the local game can handle as required.  See examples above.
+        Hand back what the blocking handlers finished, see HandlerPool.run_completed().
         '''
-        if hasattr(self, "payload"):
-            return (self.payload['name'], self.payload['game'], self.payload['message'])
+        if self.handler_pool:
+            return self.handler_pool.run_completed()
+        return 0
 
+    def dispatch(self, rcvd_msg):
+        '''
+        Run the handlers for rcvd_msg.event.
 
-class GrapevineSocket(WebSocket):
-    def __init__(self):
+        return rcvd_msg.result.
+        '''
+        for _, _, handler in self.handlers.get(rcvd_msg.event, ()):
+            if self.watchdog:
+                retvalue = self.watchdog.call(rcvd_msg.event, handler, rcvd_msg)
+            else:
+                retvalue = handler(rcvd_msg)
+            if retvalue is not None:
+                rcvd_msg.result = retvalue
+            if rcvd_msg.handled:
+                break
+        return rcvd_msg.result
+
+
+# The client itself is reachable from its handlers and messages, deep_sizeof() stops there.
+_sizeof_opaque += (HandlerRegistry,)
+
+
+class GrapevineSocket(HandlerRegistry, WebSocket):
+    def __init__(self, restore=True):
+        # With restore False the snapshot and spool files are left unread, from_state()
+        # makes one like that just for its defaults.
         super().__init__(sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY,1),))
         
         self.debug = False
 
         self.inbound_frame_buffer = []
-        self.outbound_frame_buffer = []
+        self.outbound_frame_buffer = FairOutboundQueue()
         # This event attribute is specific to AkriosMUD.  Replace with your event
         # requirements, or comment/delete the below line.
         # XXX
@@ -448,25 +2405,435 @@ class GrapevineSocket(WebSocket):
         # to also show players logged into other Grapevine connected games.
         self.other_games_players = {}
 
+        # The below decides which player status queries actually go out.  See
+        # status_queries.metrics for how many were sent and how many were saved.
+        self.status_queries = PlayerStatusCoalescer()
+
+        # The below caches the games/status details of other games.  Use
+        # request_game_status() and refresh_game_directory() to fill it, and
+        # game_directory.supporting("tells") and friends to read it.
+        self.game_directory = GameDirectory()
+
+        # The below limit how fast each player, and each channel as a whole, may send to
+        # the network: (tokens per second, burst).  Chat and tells over the limit are
+        # refused with a SendRejected the game can show the player.  Set either to None
+        # for no limit.
+        self.player_limiter = RateLimiter(rate=0.5, burst=5)
+        self.channel_limiter = RateLimiter(rate=2, burst=10)
+
+        # Set validate_tells to True to have msg_gen_player_tells() refuse tells to a game
+        # or player our caches say is certainly not there, see check_tell_target(), rather
+        # than wait on Grapevine to answer with an error.
+        # XXX
+        self.validate_tells = False
+
+        # Set shared_cache to SharedPlayerCache(path, owner=True) to publish
+        # other_games_players and the game directory for other processes on this host.
+        # XXX
+        self.shared_cache = None
+
+        # Set snapshot_path to a file name to keep other_games_players across restarts.
+        # The snapshot is rewritten at most every snapshot_interval seconds and one older
+        # than snapshot_max_age is ignored.  Games loaded from it are in stale_games until
+        # they answer the targeted refresh we send once authenticated.
+        # XXX
+        self.snapshot_path = None
+        self.snapshot_interval = 300
+        self.snapshot_max_age = 3600
+        self.last_snapshot = 0
+        self.stale_games = set()
+        # The key of each game we know of, see game_key(), to its name as Grapevine
+        # spells it, which is what queries about the game must use.
+        self.game_names = {}
+        if self.snapshot_path and restore:
+            self.load_snapshot()
+
+        # The below holds sign-ins, sign-outs, tells and chat while we are disconnected
+        # and sends them once we are authenticated again.  Give it a path to also keep
+        # it on disk across our own restarts.
+        # XXX
+        self.spool = OutboundSpool(path=None)
+        if restore:
+            self.spool.load()
+
+        # The below keeps the last lines said on each channel, for example to show a
+        # player who just logged in what they missed.  It keeps what other games say,
+        # call channel_history.add() yourself to include your own players' lines.
+        self.channel_history = ChannelHistory(capacity=100)
+
         # The below is to track the last time we received a heartbeat from Grapevine.
         self.last_heartbeat = 0
+        self.player_list_func = None
+
+        # The below are the players we have told Grapevine are online.  The whole roster
+        # goes out in a single heartbeat frame once we authenticate, see
+        # msg_gen_roster_sync(), so sign-ins and sign-outs are only sent one at a time
+        # while roster_synced.  Before that they just update the roster, and the frames
+        # and bytes that saves are counted in stats.
+        self.roster = set()
+        self.roster_synced = False
+
+        # Sign-ins and sign-outs wait presence_window seconds before they are sent.  One
+        # cancelled by its opposite in that time, a player quitting and logging straight
+        # back in, is never sent and both count in stats["presence_suppressed"].  Set to
+        # 0 to send them at once.
+        self.presence_window = 5
+
+        # The below probe the connection with a websocket ping every ping_interval
+        # seconds.  No pong within ping_timeout seconds, or the connection dropping,
+        # disconnects us and queues a "connection/lost" event for your handlers, which
+        # is the time to schedule a reconnect.  rtt_samples keeps the latest round trip
+        # times in seconds, stats has the last, lowest and highest.  Set ping_interval
+        # to None to turn probing off.
+        self.ping_interval = 15
+        self.ping_timeout = 10
+        self.ping_sent_at = 0
+        self.ping_payload = None
+        self.ping_count = 0
+        self.rtt_samples = collections.deque(maxlen=50)
+
+        # Where we connect to, and how many seconds the whole connect (DNS, TCP, TLS and
+        # the websocket upgrade) may take before we give up.  Leave ssl_context as None for
+        # the default certificate checks.  connect_state is one of
+        # "closed", "resolving", "connecting", "tls", "upgrade", "open" or "failed".
+        # connect_wait tells a select() based loop whether the connect is waiting for
+        # fileno() to become "read"able or "write"able (None while resolving).
+        self.url = "wss://grapevine.haus/socket"
+        self.connect_timeout = 30
+        self.ssl_context = None
+        self.connect_state = "closed"
+        self.connect_wait = None
+        self.connect_error = None
+        self.handshake_headers = {}
+        self._connect = {}
+
+        # The below negotiates permessage-deflate with Grapevine.  Set it to None to never
+        # ask for compression.  deflate_active says if the current connection uses it.
+        self.compression = PerMessageDeflate()
+        self.deflate_active = False
+        self._rx = bytearray()
+        self._rx_pos = 0
+        self._rx_message = None
+
+        # Set the below to True to frame and read everything ourselves rather than
+        # through websocket-client, with less copying and fewer socket reads.  Without
+        # it websocket-client is used unless permessage-deflate is in use.
+        self.lean_framing = False
+
+        # Every frame we send goes through _tx, and handle_write() frames as many queued
+        # messages as fit in write_batch_bytes before handing them to the socket in one
+        # send.  Whatever the socket does not take waits in _tx for the next call.
+        self._tx = bytearray()
+        self.write_batch_bytes = 16384
+
+        # Traffic counters.  bytes_* count message text, wire_bytes_* count the websocket
+        # frames carrying it, and deflate_seconds/inflate_seconds the time spent
+        # compressing and decompressing.  write_calls counts socket sends.
+        self.stats = {"frames_in": 0,
+                      "frames_out": 0,
+                      "write_calls": 0,
+                      "bytes_in": 0,
+                      "bytes_out": 0,
+                      "wire_bytes_in": 0,
+                      "wire_bytes_out": 0,
+                      "deflate_seconds": 0.0,
+                      "inflate_seconds": 0.0,
+                      "frames_skipped": 0,
+                      "frames_streamed": 0,
+                      "streams_failed": 0,
+                      "tells_refused": 0,
+                      "pings_sent": 0,
+                      "pongs_received": 0,
+                      "connections_lost": 0,
+                      "connects_failed": 0,
+                      "rtt_last": None,
+                      "rtt_min": None,
+                      "rtt_max": None,
+                      "roster_syncs": 0,
+                      "roster_frames_saved": 0,
+                      "roster_bytes_saved": 0,
+                      "presence_suppressed": 0}
+
+        # The below decide which inbound frames get decoded at all, see wants_frame().
+        # Answers to our own requests always are.  Drop an event from interested_events
+        # to ignore it, and add channel names to muted_channels or game names to
+        # ignored_games to skip their broadcasts or player lists.  Game names are matched
+        # through game_key(), so any capitalization of a name will do.
+        self.interested_events = {"heartbeat", "authenticate", "restart", "connection/lost",
+                                  "channels/broadcast", "channels/subscribe",
+                                  "channels/unsubscribe", "channels/send",
+                                  "players/sign-in", "players/sign-out", "players/status",
+                                  "games/connect", "games/disconnect",
+                                  "tells/send", "tells/receive"}
+        self.muted_channels = set()
+        self.ignored_games = set()
+
+        # players/status frames of stream_min_size bytes or more have their player list
+        # parsed stream_chunk names per handle_read() rather than all at once.  Set
+        # stream_min_size to None to always decode in one go.
+        self.stream_min_size = 32768
+        self.stream_chunk = 2000
+        self.stream_queue = collections.deque()
+        # The below number players/status frames as they arrive, and remember the number
+        # of the list each game's cached list came from.
+        self.status_arrivals = 0
+        self.list_arrivals = {}
+
+        # The handlers run for each inbound event, starting with the client's own.
+        self.init_handlers(CORE_HANDLERS)
 
     def gsocket_connect(self):
-        try:
-            result = self.connect("wss://grapevine.haus/socket")
-            # The below log is specific to Akrios. Leave commented or replace.
-            #comm.wiznet("gsocket_connect: Attempting connection to Grapevine.")
-        except:
+        '''
+        Start a non-blocking connection to Grapevine.
+
+        Nothing in here waits on the network.  The name lookup happens on a worker thread
+        and every later stage is advanced by gsocket_connect_step(), which handle_read()
+        and handle_write() call for you until connect_state is "open" or "failed".  Once
+        open we send our authentication.
+
+        return False if the connect could not be started, otherwise True.  Either way a
+        failure queues a "connection/lost" event, see connection_lost().
+        '''
+        # The below log is specific to Akrios. Leave commented or replace.
+        #comm.wiznet("gsocket_connect: Attempting connection to Grapevine.")
+        self._connect_close()
+
+        url = urllib.parse.urlparse(self.url)
+        if url.scheme not in ("ws", "wss") or not url.hostname:
+            self._connect_failed(ValueError(f"Not a websocket url: {self.url}"))
             return False
-        # We need to set the below on the socket as websockets.WebSocket is 
-        # blocking by default.  :(
-        self.sock.setblocking(0)
+
+        secure = url.scheme == "wss"
+        port = url.port or (443 if secure else 80)
+        path = url.path or "/"
+        if url.query:
+            path = f"{path}?{url.query}"
+
+        self._connect = {"host": url.hostname,
+                         "port": port,
+                         "path": path,
+                         "secure": secure,
+                         "deadline": time.time() + self.connect_timeout,
+                         "resolver": resolve_address(url.hostname, port),
+                         "addrs": None,
+                         "sock": None}
+        self.connect_error = None
+        self.connect_wait = None
+        self.connect_state = "resolving"
+
+        self.gsocket_connect_step()
+        return self.connect_state != "failed"
+
+    def gsocket_connect_step(self):
+        '''
+        Advance the connect as far as it can go without blocking.
+
+        Each stage either completes and hands over to the next one, or leaves connect_wait
+        set to what it is waiting for and returns.  Call it again when fileno() is ready,
+        or simply on your next pulse.
+
+        return the current connect_state.
+        '''
+        steps = {"resolving": self._connect_resolve,
+                 "connecting": self._connect_tcp,
+                 "tls": self._connect_tls,
+                 "upgrade": self._connect_upgrade}
+
+        current = None
+        while self.connect_state in steps and self.connect_state != current:
+            current = self.connect_state
+            if time.time() > self._connect["deadline"]:
+                self._connect_failed(TimeoutError(f"Connect timed out while in state {current}"))
+                break
+            try:
+                steps[current]()
+            except (OSError, ValueError) as err:
+                self._connect_failed(err)
+
+        return self.connect_state
+
+    def _connect_resolve(self):
+        resolver = self._connect["resolver"]
+        if not resolver.done():
+            self.connect_wait = None
+            return
+
+        self._connect["addrs"] = list(resolver.result())
+        self.connect_state = "connecting"
+
+    def _connect_tcp(self):
+        conn = self._connect
+
+        if conn["sock"] is None:
+            if not conn["addrs"]:
+                raise conn.get("error") or OSError(f"No usable address for {conn['host']}")
+            family, socktype, proto, _, address = conn["addrs"].pop(0)
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            for each_opt in self.sock_opt.sockopt:
+                sock.setsockopt(*each_opt)
+            conn["sock"] = sock
+            err = sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                return self._connect_next_address(OSError(err, os.strerror(err)))
+            self.connect_wait = "write"
+
+        _, writable, _ = select.select([], [conn["sock"]], [], 0)
+        if not writable:
+            return
+
+        err = conn["sock"].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            return self._connect_next_address(OSError(err, os.strerror(err)))
+
+        self.connect_state = "tls" if conn["secure"] else "upgrade"
+
+    def _connect_next_address(self, err):
+        # The address we tried refused us, so move on to the next one we resolved.
+        self._connect["sock"].close()
+        self._connect["sock"] = None
+        self._connect["error"] = err
+        self._connect_tcp()
+
+    def _connect_tls(self):
+        conn = self._connect
+
+        if not isinstance(conn["sock"], ssl.SSLSocket):
+            context = self.ssl_context or ssl.create_default_context()
+            conn["sock"] = context.wrap_socket(conn["sock"],
+                                               server_hostname=conn["host"],
+                                               do_handshake_on_connect=False)
+        try:
+            conn["sock"].do_handshake()
+        except ssl.SSLWantReadError:
+            self.connect_wait = "read"
+            return
+        except ssl.SSLWantWriteError:
+            self.connect_wait = "write"
+            return
+
+        self.connect_state = "upgrade"
+
+    def _connect_upgrade(self):
+        conn = self._connect
+        sock = conn["sock"]
+
+        if "request" not in conn:
+            conn["key"] = base64.b64encode(os.urandom(16)).decode()
+            host = conn["host"]
+            if conn["port"] not in (80, 443):
+                host = f"{host}:{conn['port']}"
+            request = (f"GET {conn['path']} HTTP/1.1\r\n"
+                       f"Host: {host}\r\n"
+                       f"Upgrade: websocket\r\n"
+                       f"Connection: Upgrade\r\n"
+                       f"Sec-WebSocket-Key: {conn['key']}\r\n"
+                       f"Sec-WebSocket-Version: 13\r\n")
+            if self.compression:
+                request += f"Sec-WebSocket-Extensions: {self.compression.offer()}\r\n"
+            request += "\r\n"
+            conn["request"] = memoryview(request.encode())
+            conn["response"] = b""
+
+        try:
+            while conn["request"]:
+                conn["request"] = conn["request"][sock.send(conn["request"]):]
+        except (ssl.SSLWantWriteError, BlockingIOError):
+            self.connect_wait = "write"
+            return
+        except ssl.SSLWantReadError:
+            self.connect_wait = "read"
+            return
+
+        try:
+            while b"\r\n\r\n" not in conn["response"]:
+                data = sock.recv(4096)
+                if not data:
+                    raise OSError("Grapevine closed the connection during the websocket upgrade")
+                conn["response"] += data
+                if len(conn["response"]) > 16384:
+                    raise ValueError("Websocket upgrade response is too large")
+        except (ssl.SSLWantReadError, BlockingIOError):
+            self.connect_wait = "read"
+            return
+        except ssl.SSLWantWriteError:
+            self.connect_wait = "write"
+            return
+
+        head, _, leftover = conn["response"].partition(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = lines[0].split(" ", 2)
+        if len(status) < 2 or status[1] != "101":
+            raise ValueError(f"Grapevine refused the websocket upgrade: {lines[0]}")
+
+        headers = {}
+        for each_line in lines[1:]:
+            name, _, value = each_line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        accept = hashlib.sha1((conn["key"] + WS_GUID).encode()).digest()
+        if headers.get("sec-websocket-accept") != base64.b64encode(accept).decode():
+            raise ValueError("Grapevine sent an invalid Sec-WebSocket-Accept header")
+
+        extensions = headers.get("sec-websocket-extensions")
+        if extensions and not self.compression:
+            raise ValueError(f"Grapevine sent an extension we did not ask for: {extensions}")
+        if extensions:
+            self.compression.accept(extensions)
+        self.deflate_active = bool(extensions)
+
+        # Hand the finished socket to our own frame reader, or to the websocket-client
+        # machinery without lean_framing or compression.  Anything Grapevine sent right
+        # behind the upgrade response is the start of the first frame.
+        self.sock = sock
+        self.connected = True
+        self.handshake_headers = headers
+        self._rx = bytearray(leftover)
+        self._rx_pos = 0
+        self._rx_message = None
+        self._tx = bytearray()
+        if leftover and not (self.deflate_active or self.lean_framing):
+            self.frame_buffer.recv_buffer.append(leftover)
+        self._connect = {}
+        self.connect_wait = None
+        self.connect_state = "open"
+        self.ping_sent_at = time.time()
+        self.ping_payload = None
+
         self.msg_gen_authenticate()
 
         # The below is a log specific to Akrios.  Leave commented or replace.
         # XXX
         #comm.wiznet("gsocket_connect: Sending Auth to Grapevine Network.")
-        return True
+
+    def _connect_failed(self, err):
+        self._connect_close()
+        self.connect_error = err
+        self.connect_wait = None
+        self.connect_state = "failed"
+        if self.debug:
+            self.debug_logger().log("connect_failed", error=repr(err))
+        # Most failures happen after gsocket_connect() has returned, so they are told to
+        # the handlers of "connection/lost", the same as losing an open connection.
+        self.stats["connects_failed"] += 1
+        self.inbound_frame_buffer.append(json.dumps(
+            {"event": "connection/lost",
+             "payload": {"reason": f"Could not connect to Grapevine: {err}"}}))
+
+    def _connect_close(self):
+        # Drop a half finished connect, if there is one.
+        if self._connect.get("sock") is not None:
+            self._connect["sock"].close()
+        self._connect = {}
+
+    def fileno(self):
+        '''
+        The descriptor to watch for this connection.  While a connect is in progress this
+        is the connecting socket, so select() on it according to connect_wait.
+        '''
+        if self.sock is None and self._connect.get("sock") is not None:
+            return self._connect["sock"].fileno()
+        return super().fileno()
 
     def gsocket_disconnect(self):
         # The below is a log specific to Akrios.  Leave commented or replace.
@@ -474,18 +2841,329 @@ class GrapevineSocket(WebSocket):
         #comm.wiznet("gsocket_disconnect: Disconnecting from Grapevine Network.")
         self.state["connected"] = False
         self.state["authenticated"] = False
+        self.roster_synced = False
+        self.save_snapshot()
+        self._connect_close()
+        self.connect_state = "closed"
+        self.connect_wait = None
         self.inbound_frame_buffer.clear()
+        # Anything still queued that matters goes to the spool.  The refs we were
+        # waiting on will never be answered on a new session.
+        for sender, frame in self.outbound_frame_buffer.items():
+            if self.spool.wants(frame):
+                self.spool.add(frame, sender)
         self.outbound_frame_buffer.clear()
-        self.events.clear()
+        self.sent_refs.clear()
+        if hasattr(self, "events"):
+            self.events.clear()
         self.subscribed.clear()
         self.other_games_players.clear()
-        self.close()
+        self.stale_games.clear()
+        self.status_queries.clear()
+        self.game_directory.cancel()
+        self.stream_queue.clear()
+        self.list_arrivals.clear()
+        self.publish_shared_cache()
+        # Send a close frame if the socket takes it right away, but do not wait for the
+        # answer the way websocket-client's close() does, for up to 3 seconds.
+        if self.sock and self.connected:
+            try:
+                self.send_close()
+            except (WebSocketConnectionClosedException, OSError):
+                pass
+        self.shutdown()
+        self._tx.clear()
+        self.stop_threads()
+
+    def save_snapshot(self):
+        '''
+        Write other_games_players and the games we know about to snapshot_path.  The
+        snapshot goes to a temporary file first and is renamed over the old one, so a
+        crash mid write never leaves a torn snapshot behind.
+
+        return True if the snapshot was written.
+        '''
+        if not self.snapshot_path:
+            return False
+
+        for info in self.game_directory.games():
+            self.game_names.setdefault(game_key(info["game"]), info["game"])
+        games = set(self.other_games_players)
+        games.update(self.game_names)
+        snapshot = {"version": 1,
+                    "saved_at": time.time(),
+                    "players": self.other_games_players,
+                    "games": sorted(games),
+                    "names": self.game_names}
+
+        temp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(temp_path, "w") as snapshot_file:
+                json.dump(snapshot, snapshot_file, separators=(",", ":"))
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as err:
+            if self.debug:
+                self.debug_logger().log("snapshot_failed", error=str(err))
+            return False
+
+        self.last_snapshot = time.time()
+        return True
+
+    def export_state(self):
+        '''
+        Hand this connection over a reload of this module, with no reconnect:
+
+            state = grapevine.gsocket.export_state()
+            importlib.reload(grapevine)
+            grapevine.gsocket = grapevine.GrapevineSocket.from_state(state)
+
+        The state is this very GrapevineSocket, with its open socket, sent_refs,
+        subscriptions, caches and queued frames, so anything of yours holding it
+        keeps working.  Handlers you attached stay attached; the client's own
+        handlers come from the reloaded module.
+
+        return the state to pass to from_state().
+        '''
+        return {"format": 1,
+                "gsock": self,
+                "core_events": sorted(CORE_HANDLERS)}
+
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Take over a connection from export_state() of an earlier version of this module.
+        The GrapevineSocket and the client objects it holds become instances of this
+        version's classes, and attributes this version added get their defaults.
+
+        return the GrapevineSocket.
+        '''
+        if state.get("format") != 1:
+            raise ValueError(f"Unknown state format {state.get('format')}")
+
+        gsock = state["gsock"]
+        fresh = cls(restore=False)
+        gsock.__class__ = cls
+        for key, value in vars(fresh).items():
+            gsock.__dict__.setdefault(key, value)
+        for key, value in fresh.stats.items():
+            gsock.stats.setdefault(key, value)
+        rebind_classes(gsock)
+        gsock.rebind_handlers(state["core_events"])
+        return gsock
+
+    def rebind_handlers(self, old_core_events):
+        '''
+        Swap the client's own handlers for those of this version of the module.  Core
+        handlers removed before the reload stay removed, and methods of ours attached as
+        handlers, like collect_presence, are bound afresh, as are those inside offloaded
+        handlers and the watchdog's and handler pool's log.
+        '''
+        if self.watchdog:
+            self.watchdog.log = self.rebound(self.watchdog.log)
+        if self.handler_pool:
+            self.handler_pool.log = self.rebound(self.handler_pool.log)
+
+        for event in set(self.handlers) | set(CORE_HANDLERS):
+            entries = []
+            had_core = event not in old_core_events
+            for priority, sequence, handler in self.handlers.get(event, ()):
+                if priority == -CORE_PRIORITY and sequence == 0:
+                    had_core = True
+                    continue
+                if isinstance(handler, OffloadedHandler):
+                    handler.handler = self.rebound(handler.handler)
+                    handler.done = self.rebound(handler.done)
+                handler = self.rebound(handler)
+                entries.append((priority, sequence, handler))
+            if had_core and event in CORE_HANDLERS:
+                entries.append((-CORE_PRIORITY, 0, CORE_HANDLERS[event]))
+            entries.sort(key=lambda entry: entry[:2])
+            self.handlers[event] = entries
+
+    def rebound(self, func):
+        '''
+        return func bound afresh if it is a method of ours, else func as it is.
+        '''
+        if isinstance(func, types.MethodType) and func.__self__ is self:
+            return getattr(self, func.__name__)
+        return func
+
+    def memory_report(self, trace=False, top=10):
+        '''
+        Account for the memory held by our caches and buffers, cheap enough for an admin
+        command.  Sizes are approximate, see deep_sizeof().
+
+        With trace set the first call starts tracemalloc, and later calls also list the
+        top lines of this file by memory allocated since, under "traced".  tracemalloc
+        slows every allocation, call tracemalloc.stop() when you are done.
+
+        return a dict of name to {"bytes": ..., "entries": ...}, plus "total".
+        '''
+        history = self.channel_history
+        sizes = {"sent_refs": (self.sent_refs, len(self.sent_refs)),
+                 "other_games_players": (self.other_games_players,
+                                         sum(len(players) for players in
+                                             self.other_games_players.values())),
+                 "stale_games": (self.stale_games, len(self.stale_games)),
+                 "game_names": (self.game_names, len(self.game_names)),
+                 "roster": (self.roster, len(self.roster)),
+                 "subscribed": (self.subscribed, len(self.subscribed)),
+                 "inbound_frame_buffer": (self.inbound_frame_buffer,
+                                          len(self.inbound_frame_buffer)),
+                 "outbound_frame_buffer": (self.outbound_frame_buffer,
+                                           len(self.outbound_frame_buffer)),
+                 "receive_buffer": ((self._rx, self._rx_message, self.frame_buffer.recv_buffer),
+                                    len(self._rx)),
+                 "send_buffer": (self._tx, len(self._tx)),
+                 "spool": (self.spool, len(self.spool)),
+                 "channel_history": (history,
+                                     sum(ring.count for ring in history.rings.values())),
+                 "game_directory": (self.game_directory, len(self.game_directory.entries)),
+                 "status_queries": (self.status_queries,
+                                    len(self.status_queries.last_refresh)),
+                 "player_limiter": (self.player_limiter,
+                                    len(self.player_limiter.buckets) if self.player_limiter else 0),
+                 "channel_limiter": (self.channel_limiter,
+                                     len(self.channel_limiter.buckets) if self.channel_limiter else 0),
+                 "handlers": (self.handlers,
+                              sum(len(handlers) for handlers in self.handlers.values())),
+                 "watchdog": (self.watchdog,
+                              len(self.watchdog.slow_calls) if self.watchdog else 0),
+                 "debug_log": (self.debug_log.records if self.debug_log else (),
+                               len(self.debug_log.records) if self.debug_log else 0),
+                 "rtt_samples": (self.rtt_samples, len(self.rtt_samples))}
+
+        report = {}
+        total = 0
+        for name, (obj, entries) in sizes.items():
+            size = deep_sizeof(obj)
+            total += size
+            report[name] = {"bytes": size,
+                            "entries": entries}
+        report["total"] = {"bytes": total,
+                           "entries": sum(each["entries"] for each in report.values())}
+
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                report["traced"] = []
+            else:
+                snapshot = tracemalloc.take_snapshot().filter_traces(
+                    (tracemalloc.Filter(True, __file__),))
+                report["traced"] = [(f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                                     stat.size, stat.count)
+                                    for stat in snapshot.statistics("lineno")[:top]]
+        return report
 
-    def send_out(self, frame):
+    def snapshot_if_due(self):
+        if self.snapshot_path and time.time() - self.last_snapshot >= self.snapshot_interval:
+            self.save_snapshot()
+
+    def load_snapshot(self):
+        '''
+        Warm other_games_players from snapshot_path.  Every game in the snapshot is
+        marked stale until it answers a refresh.
+
+        return True if a usable snapshot was loaded.
+        '''
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return False
+
+        if snapshot.get("version") != 1:
+            return False
+        if time.time() - snapshot.get("saved_at", 0) > self.snapshot_max_age:
+            return False
+
+        for game, players in snapshot["players"].items():
+            self.other_games_players.setdefault(game_key(game), list(players))
+        self.stale_games.update(game_key(game) for game in snapshot["games"])
+        self.game_names.update(snapshot.get("names", {}))
+        return True
+
+    def refresh_player_status(self):
+        '''
+        Bring other_games_players up to date after we authenticate.  With stale games
+        from a snapshot only those games are asked, otherwise every game is.
+        '''
+        if not self.stale_games or not self.other_games_players:
+            self.stale_games.clear()
+            self.msg_gen_player_status_query()
+            return
+
+        for each_game in sorted(self.stale_games):
+            self.msg_gen_player_single_status_query(self.game_names.get(each_game, each_game))
+
+    def dispatch(self, rcvd_msg):
+        '''
+        Run the handlers for rcvd_msg.event, then publish the caches to shared_cache if
+        the event may have changed them.
+
+        return rcvd_msg.result.
+        '''
+        result = super().dispatch(rcvd_msg)
+        if self.shared_cache and rcvd_msg.event in SHARED_CACHE_EVENTS:
+            self.publish_shared_cache()
+        return result
+
+    def publish_shared_cache(self):
+        if self.shared_cache:
+            self.shared_cache.publish(self.other_games_players, self.game_directory.games())
+
+    def wants_frame(self, message, event, ref, status):
+        '''
+        Decide from the sniffed event, ref and status of a raw frame whether it is worth
+        decoding.  games/status is not in interested_events by default, so only the
+        answers to our own queries are decoded.
+
+        return True to decode the frame, False to skip it.
+        '''
+        if ref is not None and ref in self.sent_refs:
+            return True
+        if event not in self.interested_events:
+            return False
+        if event == "channels/broadcast" and self.muted_channels:
+            return sniff_field(message, "channel") not in self.muted_channels
+        if event == "players/status" and self.ignored_games:
+            game = game_key(sniff_field(message, "game") or "")
+            return game not in {game_key(each_game) for each_game in self.ignored_games}
+        return True
+
+    def send_out(self, frame, sender=None):
+        '''
+        A generic to make writing out cleaner.  frame is the message dict, it is encoded
+        when it is written.  Pass the player name as sender for messages sent on a
+        player's behalf so they are queued fairly against other players.  Messages
+        that matter are spooled instead while we are not connected.
+        '''
+        if not self.state["connected"] and self.spool.wants(frame):
+            self.spool.add(frame, sender)
+            return
+
+        self.outbound_frame_buffer.append(frame, sender)
+
+    def flush_spool(self):
+        '''
+        Queue everything spooled while we were disconnected, after compacting it.
+        Spooled sign-ins and sign-outs are dropped once the roster sync has covered them.
+        '''
+        for sender, frame in self.spool.compact():
+            if self.roster_synced and frame["event"] in ("players/sign-in", "players/sign-out"):
+                self.roster_frame_saved(frame)
+                continue
+            if "ref" in frame:
+                self.sent_refs[frame["ref"]] = frame
+            self.outbound_frame_buffer.append(frame, sender)
+
+    def encode_frame(self, frame):
         '''
-        A generic to make writing out cleaner, nothing more.
+        Turn a queued message into the text we send.
         '''
-        self.outbound_frame_buffer.append(frame)
+        if isinstance(frame, str):
+            return frame
+        return json.dumps(frame, sort_keys=True, indent=4)
 
     def read_in(self):
         '''
@@ -518,7 +3196,7 @@ class GrapevineSocket(WebSocket):
 
         self.state["authenticated"] = True
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg)
 
     def msg_gen_heartbeat(self):
         '''
@@ -526,18 +3204,50 @@ class GrapevineSocket(WebSocket):
         docs indicate to respond with the below heartbeat response which 
         also provides an update player logged in list to the network.
         '''
+        self.last_heartbeat = time.time()
+        self.snapshot_if_due()
+        self.msg_gen_roster_sync()
+
+    def current_players(self):
+        '''
+        return the names of the players logged into the game.
+        '''
         # The below line builds a list of player names logged into Akrios for sending
         # in response to a grapevine heartbeat.  Replace with your functionality!
+        # A gateway sets player_list_func to the roster the game gave it.
         # XXX XXX XXX
-        player_list = [player.name.capitalize() for player in player.playerlist]
+        if self.player_list_func:
+            return self.player_list_func()
+        return [player.name.capitalize() for player in player.playerlist]
 
-        self.last_heartbeat = time.time()
+    def msg_gen_roster_sync(self, names=None):
+        '''
+        Tell Grapevine everyone who is online in one heartbeat frame, instead of a
+        players/sign-in (and its answer) per player.  names defaults to
+        current_players().  Sent for us once we authenticate and on every heartbeat.
+
+        return True if sent, False if we are not connected yet.
+        '''
+        if names is None:
+            names = self.current_players()
+        self.roster = {name.capitalize() for name in names}
+
+        if not self.state["connected"]:
+            self.roster_synced = False
+            return False
 
-        payload = {"players": player_list}
         msg = {"event": "heartbeat",
-               "payload": payload}
+               "payload": {"players": sorted(self.roster)}}
+
+        self.send_out(msg)
+        if not self.roster_synced:
+            self.stats["roster_syncs"] += 1
+        self.roster_synced = True
+        return True
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+    def roster_frame_saved(self, msg):
+        self.stats["roster_frames_saved"] += 1
+        self.stats["roster_bytes_saved"] += len(self.encode_frame(msg))
 
     def msg_gen_chan_subscribe(self, chan=None):
         '''
@@ -558,7 +3268,7 @@ class GrapevineSocket(WebSocket):
 
         self.sent_refs[ref] = msg
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg)
 
     def msg_gen_chan_unsubscribe(self, chan=None):
         '''
@@ -577,47 +3287,94 @@ class GrapevineSocket(WebSocket):
 
         self.sent_refs[ref] = msg
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg)
 
     def msg_gen_player_login(self, player_name):
         '''
-        Notify the Grapevine network of a player login.
+        Notify the Grapevine network of a player login.  Until the roster is synced
+        the player is only added to it, the sync will carry them.
         '''
+        name = player_name.capitalize()
+        if self.roster_synced and name in self.roster:
+            return
+        self.roster.add(name)
+
         ref = str(uuid.uuid4())
-        payload = {"name": player_name.capitalize()}
+        payload = {"name": name}
         msg = {"event": "players/sign-in",
                "ref": ref,
                "payload": payload}
 
-        self.sent_refs[ref] = msg
+        if not self.roster_synced:
+            self.roster_frame_saved(msg)
+            return
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_presence(name, msg)
 
     def msg_gen_player_logout(self, player_name):
         '''
-        Notify the Grapevine network of a player logout.
+        Notify the Grapevine network of a player logout.  Until the roster is synced
+        the player is only dropped from it.
         '''
+        name = player_name.capitalize()
+        if self.roster_synced and name not in self.roster:
+            return
+        self.roster.discard(name)
+
         ref = str(uuid.uuid4())
-        payload = {"name": player_name.capitalize()}
+        payload = {"name": name}
         msg = {"event": "players/sign-out",
                "ref": ref,
                "payload": payload}
 
-        self.sent_refs[ref] = msg
+        if not self.roster_synced:
+            self.roster_frame_saved(msg)
+            return
+
+        self.send_presence(name, msg)
+
+    def send_presence(self, name, msg):
+        '''
+        Queue a sign-in or sign-out for name, held for presence_window seconds.  If the
+        opposite one for name is still held, the two cancel out and neither is sent.
+        '''
+        if not self.presence_window:
+            self.sent_refs[msg["ref"]] = msg
+            self.send_out(msg)
+            return
+
+        key = ("presence", name)
+        held = self.outbound_frame_buffer.unhold(key)
+        if held is not None:
+            self.sent_refs.pop(held["ref"], None)
+            self.stats["presence_suppressed"] += 2
+            return
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.sent_refs[msg["ref"]] = msg
+        self.outbound_frame_buffer.hold(key, msg, time.time() + self.presence_window)
 
     def msg_gen_message_channel_send(self, caller, channel, message):
         '''
         Sends a channel message to the Grapevine network.  If we're not showing
-        as subscribed on our end, we bail out.
+        as subscribed on our end, or the player or channel is sending faster than
+        player_limiter or channel_limiter allow, we bail out.
+
+        return True if queued, otherwise a SendRejected saying why.
         '''
         if channel not in self.subscribed:
-            return
+            return SendRejected(f"Not subscribed to the {channel} channel.")
+
+        name = caller.name.capitalize()
+        if self.player_limiter and not self.player_limiter.allow(name):
+            return SendRejected("You are sending too fast, slow down.")
+        if self.channel_limiter and not self.channel_limiter.allow(channel):
+            if self.player_limiter:
+                self.player_limiter.refund(name)
+            return SendRejected(f"The {channel} channel is busy, try again in a moment.")
 
         ref = str(uuid.uuid4())        
         payload = {"channel": channel,
-                   "name": caller.name.capitalize(),
+                   "name": name,
                    "message": message[:290]}
         msg = {"event": "channels/send",
                "ref": ref,
@@ -625,43 +3382,90 @@ class GrapevineSocket(WebSocket):
 
         self.sent_refs[ref] = msg
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg, name)
+        return True
 
     def msg_gen_game_all_status_query(self):
         '''
         Request for all games to send full status update.  You will receive in
         return from each game quite a bit of detailed information.  See the
-        grapevine.haus Documentation or review the receiver code above.
+        grapevine.haus Documentation or review the receiver code above.  The answers
+        land in game_directory.
         '''
         ref = str(uuid.uuid4())
 
-        msg = {"events": "games/status",
+        msg = {"event": "games/status",
                "ref": ref}
 
         self.sent_refs[ref] = msg
+        previous_ref = self.game_directory.start(None, ref)
+        if previous_ref:
+            self.sent_refs.pop(previous_ref, None)
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg)
 
-    def msg_gen_game_single_status_query(self, game):
+    def msg_gen_game_single_status_query(self, game, callback=None):
         '''
         Request for a single game to send full status update.  You will receive in
         return from each game quite a bit of detailed information.  See the
-        grapevine.haus Documentation or review the receiver code above.
+        grapevine.haus Documentation or review the receiver code above.  The answer
+        lands in game_directory, and callback is handed to it (see request_game_status).
         '''
         ref = str(uuid.uuid4())
 
-        msg = {"events": "games/status",
+        msg = {"event": "games/status",
                "ref": ref,
                "payload": {"game": game}}
 
         self.sent_refs[ref] = msg
+        self.game_directory.start(game, ref, callback)
+
+        self.send_out(msg)
+
+    def request_game_status(self, game, callback=None):
+        '''
+        Look a game up in the game directory, only asking the network when we have to.
+
+        callback(game, info) is called with the games/status payload once it is known,
+        or with info None if the game could not be found.  On a cache hit that happens
+        right away, otherwise when the query we sent or joined is answered.
+
+        return the cached payload, or None if we are waiting on the network.
+        '''
+        info = self.game_directory.get(game)
+        if info:
+            self.game_directory.metrics["hits"] += 1
+            if callback:
+                callback(info["game"], info)
+            return info
+
+        self.game_directory.metrics["misses"] += 1
+        if not self.game_directory.join(game, callback):
+            self.msg_gen_game_single_status_query(game, callback)
+
+    def refresh_game_directory(self):
+        '''
+        Ask every game for its status, unless we already did within game_directory.ttl
+        or are still waiting on the answers.
+
+        return True if the query was sent.
+        '''
+        if self.game_directory.is_complete() or self.game_directory.full_pending():
+            return False
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.msg_gen_game_all_status_query()
+        return True
 
     def msg_gen_player_status_query(self):
         '''
-        This requests a player list status update from all connected games.
+        This requests a player list status update from all connected games.  A repeat
+        request inside status_queries.full_window is merged into the previous one.
+
+        return True if the query was sent.
         '''
+        if not self.status_queries.allow_full():
+            return False
+
         ref = str(uuid.uuid4())
 
         msg = {"event": "players/status",
@@ -669,29 +3473,55 @@ class GrapevineSocket(WebSocket):
 
         self.sent_refs[ref] = msg
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg)
+        return True
 
     def msg_gen_player_single_status_query(self, game):
         '''
-        Request a player list status update from a single connected game.
+        Request a player list status update from a single connected game.  The game
+        is not queried again within status_queries.min_refresh seconds.
+
+        return True if the query was sent.
         '''
+        if not self.status_queries.allow_single(game):
+            return False
+
         ref = str(uuid.uuid4())
 
-        msg = {"events": "players/status",
+        msg = {"event": "players/status",
                "ref": ref,
                "payload": {"game": game}}
 
         self.sent_refs[ref] = msg
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg)
+        return True
 
     def msg_gen_player_tells(self, caller_name, game, target, msg):
         '''
-        Send a tell message to a player on the Grapevine network.
+        Send a tell message to a player on the Grapevine network.  Tells count against
+        the sending player's player_limiter bucket.  With validate_tells set, a target
+        our caches say is not online is refused before anything is sent.
+
+        return True if queued, otherwise a SendRejected saying why.
         '''
-        game = game.capitalize()
+        game = game_key(game)
         target = target.capitalize()
 
+        if self.validate_tells and self.state["authenticated"]:
+            known_games = None
+            if self.game_directory.is_complete():
+                known_games = [info["game"] for info in self.game_directory.games()] or None
+            checked = check_tell_target(game, target, self.other_games_players,
+                                        self.stale_games, known_games)
+            if not checked:
+                self.stats["tells_refused"] += 1
+                return checked
+            game, target = checked
+
+        if self.player_limiter and not self.player_limiter.allow(caller_name.capitalize()):
+            return SendRejected("You are sending too fast, slow down.")
+
         ref = str(uuid.uuid4())
         time_now = f"{datetime.datetime.utcnow().replace(microsecond=0).isoformat()}Z"
         payload = {"from_name": caller_name,
@@ -706,38 +3536,847 @@ class GrapevineSocket(WebSocket):
 
         self.sent_refs[ref] = msg
 
-        self.send_out(json.dumps(msg, sort_keys=True, indent=4))
+        self.send_out(msg, caller_name.capitalize())
+        return True
 
     def handle_read(self):
         '''
-        Perform the actual socket read attempt. Append anything received to the inbound
-        buffer.
+        Perform the actual socket read attempt. Append everything the socket has for us
+        to the inbound buffer.  While we are still connecting this advances the connect instead.  Results
+        of blocking handlers are handed back, and streamed frames advanced, here too.
         '''
+        self.run_completed()
+        self.advance_streams()
+        if self.connect_state != "open":
+            self.gsocket_connect_step()
+            return
+
         try:
-            self.inbound_frame_buffer.append(self.recv())
-            if self.debug:
-                print(f"Grapevine In: {self.inbound_frame_buffer[-1]}")
-                print("")
+            if self.deflate_active or self.lean_framing:
+                self.recv_messages()
+            else:
+                # websocket-client reads one frame at a time, so keep at it until the
+                # socket has nothing more for us.
+                while True:
+                    for each_message in self.recv_message():
+                        self.queue_message(each_message)
+        except (ssl.SSLWantReadError, BlockingIOError):
+            pass
+        except (WebSocketConnectionClosedException, OSError) as err:
+            self.connection_lost(f"Connection to Grapevine lost: {err}")
+            return
         except:
             pass
 
+        self.check_liveness()
+
+    def advance_streams(self):
+        '''
+        Parse up to stream_chunk more player names of the streamed players/status frames
+        waiting in stream_queue, dispatching each one whose list is complete.
+        '''
+        budget = self.stream_chunk
+        while self.stream_queue and budget > 0:
+            rcvd_msg = self.stream_queue[0]
+            budget -= rcvd_msg.streaming.step(budget)
+            if rcvd_msg.streaming.done:
+                self.stream_queue.popleft()
+                if rcvd_msg.streaming.error:
+                    self.stream_failed(rcvd_msg)
+                else:
+                    self.dispatch(rcvd_msg)
+
+    def stream_failed(self, rcvd_msg):
+        '''
+        A streamed players/status turned out to be malformed.  It is dropped, the game's
+        cached list is left as it was.
+        '''
+        self.stats["streams_failed"] += 1
+        self.sent_refs.pop(getattr(rcvd_msg, "ref", None), None)
+        if self.debug:
+            self.debug_logger().log("stream_failed", game=rcvd_msg.payload["game"],
+                                    error=rcvd_msg.streaming.error)
+
+    def streams_for(self, game):
+        '''
+        return the streamed players/status frames for game still being parsed.
+        '''
+        return [rcvd_msg for rcvd_msg in self.stream_queue
+                if game_key(rcvd_msg.payload["game"] or "") == game]
+
+    def queue_message(self, message):
+        '''
+        Add a text message read from Grapevine to inbound_frame_buffer.
+        '''
+        self.inbound_frame_buffer.append(message)
+        if self.debug:
+            self.debug_logger().frame("in", message)
+
+    def recv_message(self):
+        '''
+        Read one frame through websocket-client, asking it for control frames as well so
+        we see the pongs to our pings.
+
+        return a list with the text message read, if any.
+        '''
+        opcode, frame = self.recv_data_frame(True)
+        if opcode == ABNF.OPCODE_PONG:
+            self.pong_received(frame.data)
+            return []
+        if opcode != ABNF.OPCODE_TEXT:
+            return []
+
+        message = frame.data.decode("utf-8")
+        size = len(frame.data)
+        self.stats["frames_in"] += 1
+        self.stats["bytes_in"] += size
+        self.stats["wire_bytes_in"] += size + self.frame_overhead(size, False)
+        return [message]
+
+    def check_liveness(self):
+        '''
+        Send a ping when one is due, and give up on the connection when the last one
+        went unanswered for ping_timeout seconds.  handle_read() calls this.
+        '''
+        if not self.ping_interval or self.connect_state != "open":
+            return
+
+        now = time.time()
+        if self.ping_payload is not None:
+            if now - self.ping_sent_at > self.ping_timeout:
+                self.connection_lost(f"No pong from Grapevine in {self.ping_timeout} seconds.")
+            return
+
+        if now - self.ping_sent_at < self.ping_interval:
+            return
+
+        self.ping_count += 1
+        payload = str(self.ping_count).encode()
+        try:
+            self.send_frame(ABNF.create_frame(payload, ABNF.OPCODE_PING))
+        except (ssl.SSLWantWriteError, BlockingIOError):
+            return
+        except (WebSocketConnectionClosedException, OSError) as err:
+            self.connection_lost(f"Connection to Grapevine lost: {err}")
+            return
+        self.ping_payload = payload
+        self.ping_sent_at = now
+        self.stats["pings_sent"] += 1
+
+    def pong_received(self, payload):
+        '''
+        Record the round trip time of our outstanding ping.  Unsolicited pongs are
+        ignored.
+        '''
+        if payload != self.ping_payload:
+            return
+
+        rtt = time.time() - self.ping_sent_at
+        self.ping_payload = None
+        self.rtt_samples.append(rtt)
+        self.stats["pongs_received"] += 1
+        self.stats["rtt_last"] = rtt
+        if self.stats["rtt_min"] is None or rtt < self.stats["rtt_min"]:
+            self.stats["rtt_min"] = rtt
+        if self.stats["rtt_max"] is None or rtt > self.stats["rtt_max"]:
+            self.stats["rtt_max"] = rtt
+
+    def connection_lost(self, reason):
+        '''
+        The connection is dead.  Disconnect and queue a "connection/lost" event, as if
+        from Grapevine, so the handlers for it can schedule a reconnect.
+        '''
+        # The below is a log specific to Akrios.  Leave commented or replace.
+        # XXX
+        #comm.wiznet(f"connection_lost: {reason}")
+        if self.debug:
+            self.debug_logger().log("connection_lost", reason=reason)
+        self.stats["connections_lost"] += 1
+        # Skip the close frame, nobody is there to answer it.  Frames read before the
+        # connection died are still handled, ahead of the event.
+        self.connected = False
+        unread = list(self.inbound_frame_buffer)
+        self.gsocket_disconnect()
+        self.inbound_frame_buffer.extend(unread)
+        self.inbound_frame_buffer.append(json.dumps({"event": "connection/lost",
+                                                     "payload": {"reason": reason}}))
+
+    def frame_overhead(self, size, masked=True):
+        '''
+        return the bytes of websocket framing around a payload of size bytes.
+        '''
+        overhead = 6 if masked else 2
+        if size > 65535:
+            return overhead + 8
+        if size > 125:
+            return overhead + 2
+        return overhead
+
+    def recv_messages(self):
+        '''
+        Read whatever the socket has for us and queue the complete text messages in it,
+        each as soon as it is decoded, see queue_message().
+
+        This is our own frame reader, used with lean_framing and always with
+        permessage-deflate, since websocket-client refuses frames with the RSV1 bit that
+        marks a compressed message.  Everything waiting is read in one go and frames are
+        taken from the buffer as views, so a message is only copied when it is decoded.
+        Pings are answered, pongs timed and a close frame closes our side too.  A message
+        that does not decode fails the connection, as RFC 6455 asks.
+        '''
+        # Nothing still holds a view from the last call, drop the frames it took.
+        if self._rx_pos:
+            del self._rx[:self._rx_pos]
+            self._rx_pos = 0
+
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (ssl.SSLWantReadError, BlockingIOError):
+                break
+            if not data:
+                self.connected = False
+                raise WebSocketConnectionClosedException("Grapevine closed the connection")
+            self._rx += data
+
+        while True:
+            frame = self.take_frame()
+            if frame is None:
+                break
+            fin, compressed, opcode, payload = frame
+
+            if opcode >= ABNF.OPCODE_CLOSE:
+                # Control frames may arrive between the fragments of a message.
+                if (not fin or compressed or len(payload) > 125
+                        or opcode not in (ABNF.OPCODE_CLOSE, ABNF.OPCODE_PING, ABNF.OPCODE_PONG)):
+                    raise WebSocketConnectionClosedException("Grapevine sent a bad control frame")
+                payload = bytes(payload)
+                if opcode == ABNF.OPCODE_PING:
+                    self.pong(payload)
+                elif opcode == ABNF.OPCODE_PONG:
+                    self.pong_received(payload)
+                elif opcode == ABNF.OPCODE_CLOSE:
+                    self.send_close()
+                    break
+                continue
+
+            # Grapevine only sends text, and only a compressed message may set RSV1 on its
+            # first frame.
+            if opcode not in (ABNF.OPCODE_CONT, ABNF.OPCODE_TEXT):
+                raise WebSocketConnectionClosedException(f"Grapevine sent a frame with opcode {opcode}")
+            if compressed and (not self.deflate_active or opcode == ABNF.OPCODE_CONT):
+                raise WebSocketConnectionClosedException("Grapevine sent a frame with RSV1 set")
+
+            if opcode != ABNF.OPCODE_CONT:
+                if fin:
+                    # The usual case, a whole message in one frame.
+                    self.queue_message(self.message_text(compressed, payload))
+                    continue
+                self._rx_message = [compressed, []]
+            elif self._rx_message is None:
+                continue
+            self._rx_message[1].append(payload)
+            if not fin:
+                continue
+
+            compressed, parts = self._rx_message
+            self._rx_message = None
+            self.queue_message(self.message_text(compressed, b"".join(parts)))
+
+        # The fragments of a message still coming must not keep views into _rx.
+        if self._rx_message is not None:
+            self._rx_message[1] = [bytes(part) for part in self._rx_message[1]]
+
+    def message_text(self, compressed, data):
+        '''
+        return the text of a whole message, inflating it first if compressed.
+        '''
+        try:
+            if compressed:
+                started = time.perf_counter()
+                data = self.compression.decompress(data)
+                self.stats["inflate_seconds"] += time.perf_counter() - started
+            text = str(data, "utf-8")
+        except (zlib.error, UnicodeDecodeError) as err:
+            raise WebSocketConnectionClosedException(f"Grapevine sent a message we cannot decode: {err}")
+        self.stats["frames_in"] += 1
+        self.stats["bytes_in"] += len(data)
+        return text
+
+    def take_frame(self):
+        '''
+        Take the next complete frame from our receive buffer, starting at _rx_pos.
+
+        return (fin, rsv1, opcode, payload), or None if no whole frame has arrived yet.
+        Unless the frame was masked payload is a memoryview into the buffer, good until
+        the next recv_messages() call.
+        '''
+        rx = self._rx
+        start = self._rx_pos
+        available = len(rx) - start
+        if available < 2:
+            return None
+
+        first = rx[start]
+        if first & 0x30:
+            raise WebSocketConnectionClosedException("Grapevine sent a frame with RSV2 or RSV3 set")
+        length = rx[start + 1] & 0x7f
+        offset = start + 2
+        if length == 126:
+            if available < 4:
+                return None
+            length = _frame_medium.unpack_from(rx, start)[2]
+            offset += 2
+        elif length == 127:
+            if available < 10:
+                return None
+            length = _frame_long.unpack_from(rx, start)[2]
+            offset += 8
+
+        mask = None
+        if rx[start + 1] & 0x80:
+            mask = bytes(rx[offset:offset + 4])
+            offset += 4
+        end = offset + length
+        if len(rx) < end:
+            return None
+
+        payload = memoryview(rx)[offset:end]
+        if mask:
+            payload = mask_payload(mask, payload)
+        self._rx_pos = end
+        self.stats["wire_bytes_in"] += end - start
+        return first >> 7, first >> 6 & 1, first & 0x0f, payload
+
+    def text_frame(self, text):
+        '''
+        return the websocket frame for one text message, compressed if permessage-deflate
+        is in use.
+        '''
+        data = text.encode("utf-8")
+        self.stats["frames_out"] += 1
+        self.stats["bytes_out"] += len(data)
+
+        compressed = self.deflate_active and len(data) >= self.compression.min_size
+        if compressed:
+            started = time.perf_counter()
+            data = self.compression.compress(data)
+            self.stats["deflate_seconds"] += time.perf_counter() - started
+
+        self.stats["wire_bytes_out"] += len(data) + self.frame_overhead(len(data))
+        return ABNF(1, int(compressed), 0, 0, ABNF.OPCODE_TEXT, 1, data)
+
+    def send_text(self, text):
+        '''
+        Send one text message, compressed if permessage-deflate is in use.
+        '''
+        return self.send_frame(self.text_frame(text))
+
+    def send_frame(self, frame):
+        '''
+        Replaces websocket-client's send_frame() so pings, pongs and closes queue behind
+        any batch still partly unwritten in _tx instead of cutting into it.
+
+        return the length of the frame.
+        '''
+        data = self.format_frame(frame)
+        self._tx += data
+        self.flush_tx()
+        return len(data)
+
+    def format_frame(self, frame):
+        '''
+        return the bytes on the wire for frame, an ABNF.
+        '''
+        if self.lean_framing:
+            return ws_frame(frame.opcode, frame.data, frame.fin, frame.rsv1)
+        return frame.format()
+
+    def wants_write(self):
+        '''
+        return True if handle_write() has anything to do: queued messages, the rest of a
+        partly written batch in _tx, or a connect in progress.
+        '''
+        return bool(self._tx) or len(self.outbound_frame_buffer) > 0 or (
+            self.connect_state not in ("open", "closed", "failed"))
+
+    def flush_tx(self):
+        '''
+        Write as much of _tx as the socket takes without blocking.  A TLS write that
+        wants to wait is retried with the same buffer on the next call.
+
+        return True once _tx is empty.
+        '''
+        while self._tx:
+            try:
+                sent = self.sock.send(self._tx)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError,
+                    InterruptedError):
+                return False
+            self.stats["write_calls"] += 1
+            del self._tx[:sent]
+        return True
+
     def handle_write(self):
         '''
-        Perform a write out to Grapevine from the outbound buffer.
+        Perform a write out to Grapevine from the outbound buffer.  Queued messages are
+        framed into one batch of up to write_batch_bytes for a single socket send, after
+        anything left over from the last batch.  While we are still connecting this
+        advances the connect instead.  A socket that fails the write loses the connection.
         '''
+        if self.connect_state != "open":
+            self.gsocket_connect_step()
+            return
+
         try:
-            outdata = self.outbound_frame_buffer.pop(0)
-            if outdata != None:
-                self.send(outdata)
+            if not self.flush_tx():
+                return
+            if not self.outbound_frame_buffer.release():
+                return
+
+            while self.outbound_frame_buffer.length and len(self._tx) < self.write_batch_bytes:
+                outdata = self.encode_frame(self.outbound_frame_buffer.popleft())
+                self._tx += self.format_frame(self.text_frame(outdata))
                 if self.debug:
-                    print(f"Grapevine Out: {outdata}")
-                    print("")
-        except:
+                    self.debug_logger().frame("out", outdata)
+            self.flush_tx()
+        except (WebSocketConnectionClosedException, OSError) as err:
+            self.connection_lost(f"Connection to Grapevine lost: {err}")
+        except Exception as err:
             if self.debug:
-                print(f"Error sending data frame: {outdata}")
+                self.debug_logger().log("send_failed", error=repr(err))
 
     def receive_message(self):
         return GrapevineReceivedMessage(self.read_in(), self)
 
 
+# Gateway mode.  A separate process, started with "python3 grapevine.py --gateway PATH",
+# owns the Grapevine connection, its caches and the heartbeats.  The game talks to it over
+# a Unix domain socket at PATH through GrapevineGatewayClient, which offers the same
+# msg_gen_* methods, handlers and caches as GrapevineSocket.  Since the Grapevine session
+# lives in the gateway, a game restart or copyover only reconnects to the local socket.
+#
+# Each frame between the two is a 5 byte header, the kind and the body length, followed by
+# the body in marshal format, so neither side parses JSON.  Both ends must be the same
+# Python version; keep PATH in a directory only the game's user can reach.
+GATEWAY_EVENT = 1
+GATEWAY_STATE = 2
+GATEWAY_CALL = 3
+GATEWAY_HEADER = struct.Struct("!BI")
+GATEWAY_CALLS = ("set_roster", "refresh_game_directory", "refresh_player_status")
+# The events that may change what a state frame mirrors to the game.
+GATEWAY_STATE_EVENTS = SHARED_CACHE_EVENTS | {"authenticate", "channels/subscribe",
+                                              "channels/unsubscribe", "restart",
+                                              "connection/lost"}
+
+
+def gateway_frame(kind, body):
+    body = marshal.dumps(body)
+    return GATEWAY_HEADER.pack(kind, len(body)) + body
+
+
+def gateway_frames(buffer):
+    '''
+    Take every complete frame off the front of buffer.
+
+    return a list of (kind, body).
+    '''
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= GATEWAY_HEADER.size:
+        kind, length = GATEWAY_HEADER.unpack_from(buffer, offset)
+        end = offset + GATEWAY_HEADER.size + length
+        if len(buffer) < end:
+            break
+        frames.append((kind, marshal.loads(bytes(buffer[offset + GATEWAY_HEADER.size:end]))))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+
+def gateway_send(sock, buffer):
+    '''
+    Write as much of buffer to sock as it takes without blocking.
+    '''
+    try:
+        sent = sock.send(buffer)
+    except (BlockingIOError, InterruptedError):
+        return
+    del buffer[:sent]
+
+
+def gateway_recv(sock, buffer):
+    '''
+    Read everything waiting on sock into buffer.
+
+    return False once the other side has closed the connection.
+    '''
+    while True:
+        try:
+            data = sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        if not data:
+            return False
+        buffer += data
+
+
+class GrapevineGateway(object):
+    '''
+    The sidecar end of gateway mode.  Runs gsock, a GrapevineSocket, and serves one game
+    connection at a time on the Unix socket at path; a new game connection replaces the
+    old one, which is what a copyover looks like from here.
+
+    Every decoded event goes to the game with the client's own handlers already run, and
+    whenever the caches may have changed a state frame mirrors them to the game.
+    '''
+    def __init__(self, gsock, path, reconnect_delay=30):
+        super().__init__()
+        self.gsock = gsock
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_at = 0
+        self.listener = None
+        self.game = None
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.dirty = True
+
+        # The game is the one rate limiting and keeping the roster.  Events go to the
+        # game as soon as they are parsed, and a long parse here does not hold up the
+        # game, so nothing is streamed.
+        gsock.player_limiter = None
+        gsock.channel_limiter = None
+        gsock.stream_min_size = None
+        gsock.player_list_func = lambda: sorted(gsock.roster)
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.listener.listen(1)
+        self.listener.setblocking(False)
+
+    def serve_forever(self, pulse=0.05):
+        self.listen()
+        while True:
+            watch = [self.listener]
+            if self.game:
+                watch.append(self.game)
+            if self.gsock.sock or self.gsock.connect_state not in ("closed", "failed"):
+                try:
+                    watch.append(self.gsock.fileno())
+                except Exception:
+                    pass
+            select.select(watch, [], [], pulse)
+            self.pulse()
+
+    def pulse(self):
+        '''
+        One pass over everything the gateway does.  serve_forever() calls this whenever
+        a socket is ready or every pulse seconds.
+        '''
+        self.accept_game()
+        self.keep_connected()
+        self.pump_grapevine()
+        self.pump_game()
+
+    def accept_game(self):
+        try:
+            game, _ = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if self.game:
+            self.game.close()
+        game.setblocking(False)
+        self.game = game
+        self.rx.clear()
+        self.tx.clear()
+        self.dirty = True
+
+    def keep_connected(self):
+        gsock = self.gsock
+        if gsock.connect_state in ("closed", "failed") and time.time() >= self.reconnect_at:
+            self.reconnect_at = time.time() + self.reconnect_delay
+            gsock.gsocket_connect()
+            self.dirty = True
+
+    def pump_grapevine(self):
+        gsock = self.gsock
+        before = gsock.connect_state
+
+        for _ in range(100):
+            buffered = len(gsock.inbound_frame_buffer)
+            gsock.handle_read()
+            if len(gsock.inbound_frame_buffer) == buffered:
+                break
+
+        while gsock.inbound_frame_buffer:
+            rcvd_msg = gsock.receive_message()
+            rcvd_msg.parse_frame()
+            if rcvd_msg.skipped:
+                continue
+            self.forward(rcvd_msg)
+            if rcvd_msg.event == "restart":
+                gsock.gsocket_disconnect()
+                self.reconnect_at = time.time() + 15 + rcvd_msg.restart_downtime
+
+        # Write until nothing is left or the socket stops taking it.  Frames held back by
+        # the rate limits stay queued for a later pump.
+        while gsock.wants_write():
+            pending = (len(gsock._tx), len(gsock.outbound_frame_buffer))
+            gsock.handle_write()
+            if (len(gsock._tx), len(gsock.outbound_frame_buffer)) == pending:
+                break
+
+        if gsock.connect_state != before:
+            self.dirty = True
+
+    def forward(self, rcvd_msg):
+        if rcvd_msg.event in GATEWAY_STATE_EVENTS:
+            self.dirty = True
+        if not self.game:
+            return
+
+        attrs = {key: value for key, value in vars(rcvd_msg).items()
+                 if key not in ("gsock", "handled", "skipped")}
+        try:
+            self.tx += gateway_frame(GATEWAY_EVENT, attrs)
+        except ValueError:
+            attrs["result"] = None
+            self.tx += gateway_frame(GATEWAY_EVENT, attrs)
+
+    def pump_game(self):
+        if not self.game:
+            return
+
+        if not gateway_recv(self.game, self.rx):
+            self.game.close()
+            self.game = None
+            return
+
+        for kind, body in gateway_frames(self.rx):
+            if kind == GATEWAY_CALL:
+                self.call(*body)
+
+        if self.dirty:
+            gsock = self.gsock
+            self.tx += gateway_frame(GATEWAY_STATE,
+                                     {"state": gsock.state,
+                                      "connect_state": gsock.connect_state,
+                                      "subscribed": gsock.subscribed,
+                                      "other_games_players": gsock.other_games_players,
+                                      "stale_games": list(gsock.stale_games)})
+            self.dirty = False
+
+        if self.tx:
+            gateway_send(self.game, self.tx)
+
+    def call(self, name, args):
+        '''
+        Run a msg_gen_* method, or one of GATEWAY_CALLS, on behalf of the game.
+        '''
+        if name == "set_roster":
+            self.gsock.msg_gen_roster_sync(args[0])
+            return
+        if name == "msg_gen_message_channel_send":
+            args = (types.SimpleNamespace(name=args[0]),) + tuple(args[1:])
+        elif not name.startswith("msg_gen_") and name not in GATEWAY_CALLS:
+            return
+
+        getattr(self.gsock, name)(*args)
+
+
+class GatewayMessage(SyntheticMessage):
+    '''
+    An event forwarded by the gateway.  It arrives already decoded and with the client's
+    own handlers already run, so only the game's handlers are left to dispatch.
+    '''
+
+
+class GrapevineGatewayClient(HandlerRegistry):
+    '''
+    The game end of gateway mode, a stand in for GrapevineSocket.
+
+    Use it exactly as you would GrapevineSocket: gsocket_connect(), handle_read(),
+    handle_write(), receive_message() and parse_frame(), the msg_gen_* methods and
+    on() for handlers.  state, subscribed, other_games_players and stale_games mirror
+    the gateway's.  Tell it who is online after a restart with set_roster().
+    '''
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.sock = None
+        self.debug = False
+        self.rx = bytearray()
+        self.inbound_frame_buffer = []
+        self.outbound_frame_buffer = bytearray()
+
+        self.state = {"connected": False,
+                      "authenticated": False}
+        self.connect_state = "closed"
+        self.subscribed = {}
+        self.other_games_players = {}
+        self.stale_games = set()
+        self.roster = set()
+        # Only a roster the game gave us with set_roster() is complete enough to push
+        # to the gateway, a new process has not seen its players yet.
+        self.roster_set = False
+        self.player_limiter = RateLimiter(rate=0.5, burst=5)
+        self.channel_limiter = RateLimiter(rate=2, burst=10)
+        self.validate_tells = False
+
+        self.interested_events = set()
+        self.init_handlers()
+
+    def gsocket_connect(self):
+        '''
+        Connect to the gateway.  Connecting to a local socket never waits on the network.
+
+        return True if connected.
+        '''
+        self.gsocket_disconnect()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            return False
+        sock.setblocking(False)
+        self.sock = sock
+        if self.roster_set:
+            self.call("set_roster", sorted(self.roster))
+        return True
+
+    def gsocket_disconnect(self):
+        '''
+        Drop our connection to the gateway.  The Grapevine session itself stays up.
+        '''
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.rx.clear()
+        self.outbound_frame_buffer.clear()
+        self.stop_threads()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle_read(self):
+        self.run_completed()
+        if not self.sock:
+            return
+        if not gateway_recv(self.sock, self.rx):
+            self.gsocket_disconnect()
+            return
+
+        for kind, body in gateway_frames(self.rx):
+            if kind == GATEWAY_EVENT:
+                self.inbound_frame_buffer.append(body)
+            elif kind == GATEWAY_STATE:
+                self.state = body["state"]
+                self.connect_state = body["connect_state"]
+                self.subscribed = body["subscribed"]
+                self.other_games_players = body["other_games_players"]
+                self.stale_games = set(body["stale_games"])
+
+    def handle_write(self):
+        if self.sock and self.outbound_frame_buffer:
+            gateway_send(self.sock, self.outbound_frame_buffer)
+
+    def wants_write(self):
+        '''
+        return True if handle_write() has anything to send to the gateway.
+        '''
+        return bool(self.sock and self.outbound_frame_buffer)
+
+    def receive_message(self):
+        return GatewayMessage(self.inbound_frame_buffer.pop(0), self)
+
+    def call(self, name, *args):
+        self.outbound_frame_buffer += gateway_frame(GATEWAY_CALL, (name, args))
+
+    def __getattr__(self, name):
+        if name.startswith("msg_gen_"):
+            return lambda *args: self.call(name, *args)
+        raise AttributeError(name)
+
+    def set_roster(self, names):
+        '''
+        Tell the gateway every player who is online, for its heartbeats.
+        '''
+        self.roster = {name.capitalize() for name in names}
+        self.roster_set = True
+        self.call("set_roster", sorted(self.roster))
+
+    def refresh_player_status(self):
+        self.call("refresh_player_status")
+
+    def refresh_game_directory(self):
+        self.call("refresh_game_directory")
+
+    def msg_gen_player_login(self, player_name):
+        self.roster.add(player_name.capitalize())
+        self.call("msg_gen_player_login", player_name)
+
+    def msg_gen_player_logout(self, player_name):
+        self.roster.discard(player_name.capitalize())
+        self.call("msg_gen_player_logout", player_name)
+
+    def msg_gen_message_channel_send(self, caller, channel, message):
+        '''
+        Rate limited here like GrapevineSocket.msg_gen_message_channel_send().
+
+        return True if passed to the gateway, otherwise a SendRejected saying why.
+        '''
+        if channel not in self.subscribed:
+            return SendRejected(f"Not subscribed to the {channel} channel.")
+        name = caller.name.capitalize()
+        if self.player_limiter and not self.player_limiter.allow(name):
+            return SendRejected("You are sending too fast, slow down.")
+        if self.channel_limiter and not self.channel_limiter.allow(channel):
+            if self.player_limiter:
+                self.player_limiter.refund(name)
+            return SendRejected(f"The {channel} channel is busy, try again in a moment.")
+
+        self.call("msg_gen_message_channel_send", name, channel, message)
+        return True
+
+    def msg_gen_player_tells(self, caller_name, game, target, msg):
+        '''
+        Rate limited and checked here like GrapevineSocket.msg_gen_player_tells().
+
+        return True if passed to the gateway, otherwise a SendRejected saying why.
+        '''
+        if self.validate_tells and self.state["authenticated"]:
+            checked = check_tell_target(game, target, self.other_games_players,
+                                        self.stale_games)
+            if not checked:
+                return checked
+            game, target = checked
+
+        if self.player_limiter and not self.player_limiter.allow(caller_name.capitalize()):
+            return SendRejected("You are sending too fast, slow down.")
+
+        self.call("msg_gen_player_tells", caller_name, game, target, msg)
+        return True
+
+
+def run_gateway(path):
+    '''
+    Run a gateway serving the Unix socket at path.  Never returns.
+    '''
+    GrapevineGateway(GrapevineSocket(), path).serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Grapevine client gateway.")
+    parser.add_argument("--gateway", metavar="PATH", required=True,
+                        help="Unix domain socket to serve the game on.")
+    run_gateway(parser.parse_args().gateway)
@@ -125,6 +125,8 @@ def init_events_server(server):
     pass
 
 def init_events_grapevine(grapevine_):
+    init_grapevine_handlers(grapevine_)
+
     event = Event()
     event.owner = grapevine_
     event.ownertype = "grapevine"
@@ -245,101 +247,139 @@ def reoccuring_event(func_to_decorate):
 
 def event_grapevine_restart(event_):
     comm.wiznet("Grapevine restart event initiated")
+    # Carry over anything spooled while we were disconnected.
+    spool = grapevine.gsocket.spool
     del(grapevine.gsocket)
 
     grapevine.gsocket = grapevine.GrapevineSocket()
-    grapevine_connected = grapevine.gsocket.gsocket_connect()
-    if grapevine_connected == False:
-        comm.wiznet("Could not connect to Grapevine in event restart")
+    grapevine.gsocket.spool = spool
+    # A connect that fails, right away or while it completes, is handed to the
+    # connection/lost handler below, which tries again.
+    grapevine.gsocket.gsocket_connect()
 
 @reoccuring_event
 def event_grapevine_send_message(event_):
-    if len(event_.owner.outbound_frame_buffer) > 0:
+    # Also true while part of an earlier batch is waiting on the socket.
+    if event_.owner.wants_write():
         event_.owner.handle_write()
 
 @reoccuring_event
 def event_grapevine_receive_message(event_):
     grapevine_ = event_.owner
     grapevine_.handle_read()
-    if len(grapevine_.inbound_frame_buffer) > 0:
-        # Assign rcvd_msg to a GrapevineReceivedMessage instance.
-        rcvd_msg = grapevine_.receive_message()
-        ret_value = rcvd_msg.parse_frame()
-
-        if ret_value:
-            # We will receive a "tells/send" if there was an error telling a
-            # foreign game player.
-            if rcvd_msg.event == "tells/send":
-                caller, target, game, error_msg = ret_value
-                message = (f"\n\r{{GMultiMUD Tell to {{y{target}@{game}{{G "
-                           f"returned an Error{{x: {{R{error_msg}{{x")
-                for eachplayer in player.playerlist:
-                    if eachplayer.name.capitalize() == caller:
-                        if eachplayer.oocflags_stored['mmchat'] == 'true':
-                            eachplayer.write(message)
-                            return
-
-            if rcvd_msg.event == "tells/receive":
-                sender, target, game, sent, message = ret_value
-                message = (f"\n\r{{GMultiMUD Tell from {{y{sender}@{game}{{x: "
-                           f"{{G{message}{{x.\n\rReceived at : {sent}.")
-                for eachplayer in player.playerlist:
-                    if eachplayer.name.capitalize() == target.capitalize():
-                        if eachplayer.oocflags_stored['mmchat'] == 'true':
-                            eachplayer.write(message)
-                            return
-
-            if rcvd_msg.event == "games/status":
-                if ret_value:
-                    # We've received a game status request response from
-                    # grapevine.  Do what you will here with the information,
-                    # Not going to do anything with it in Akrios at the moment.
-                    return
+    # Handle everything that came in since the last pulse.  This runs the handlers
+    # registered in init_grapevine_handlers() below.
+    grapevine_.process_pending()
+
+
+def init_grapevine_handlers(grapevine_):
+    # Our handlers for Grapevine events.  The client's own handlers have already
+    # updated its caches and left their return value in rcvd_msg.result.
 
+    def write_mmchat_players(message):
+        for eachplayer in player.playerlist:
+            if eachplayer.oocflags_stored['mmchat'] == 'true':
+                eachplayer.write(message)
 
-            # Received Grapevine Info that goes to all players goes here.
-            message = ""
-            if rcvd_msg.event == "games/connect":
-                game = ret_value.capitalize()
-                message = f"\n\r{{GMultiMUD Status Update: {game} connected to network{{x"
-            if rcvd_msg.event == "games/disconnect":
-                game = ret_value.capitalize()
-                message = f"\n\r{{GMultiMUD Status Update: {game} disconnected from network{{x"
-            if rcvd_msg.event == "channels/broadcast":
-                name, game, message = ret_value
-                if name == None or game == None:
-                    comm.wiznet("Received channels/broadcast with None type")
+    # We will receive a "tells/send" if there was an error telling a
+    # foreign game player.
+    @grapevine_.on("tells/send")
+    def grapevine_tell_error(rcvd_msg):
+        if not rcvd_msg.result:
+            return
+        caller, target, game, error_msg = rcvd_msg.result
+        message = (f"\n\r{{GMultiMUD Tell to {{y{target}@{game}{{G "
+                   f"returned an Error{{x: {{R{error_msg}{{x")
+        for eachplayer in player.playerlist:
+            if eachplayer.name.capitalize() == caller:
+                if eachplayer.oocflags_stored['mmchat'] == 'true':
+                    eachplayer.write(message)
                     return
-                message = (f"\n\r{{GMultiMUD Chat{{x:{{y{name.capitalize()}"
-                           f"@{game.capitalize()}{{x:{{G{message}{{x")
-            if rcvd_msg.is_other_game_player_update():
-                name, inout, game = ret_value
-                if name == None or game == None:
-                    comm.wiznet("Received other game player update")
+
+    @grapevine_.on("tells/receive")
+    def grapevine_tell_received(rcvd_msg):
+        if not rcvd_msg.result:
+            return
+        sender, target, game, sent, message = rcvd_msg.result
+        message = (f"\n\r{{GMultiMUD Tell from {{y{sender}@{game}{{x: "
+                   f"{{G{message}{{x.\n\rReceived at : {sent}.")
+        for eachplayer in player.playerlist:
+            if eachplayer.name.capitalize() == target.capitalize():
+                if eachplayer.oocflags_stored['mmchat'] == 'true':
+                    eachplayer.write(message)
                     return
-                message = (f"\n\r{{GMultiMUD Chat{{x: {{y{name.capitalize()}{{G "
-                           f"has {inout} {{Y{game.capitalize()}{{x.")
 
-            if message != "":
-                for eachplayer in player.playerlist:
-                    if eachplayer.oocflags_stored['mmchat'] == 'true':
-                        eachplayer.write(message)
-                return
+    # Received Grapevine Info that goes to all players goes here.
+    @grapevine_.on("games/connect")
+    def grapevine_game_connected(rcvd_msg):
+        if rcvd_msg.result:
+            game = rcvd_msg.result.capitalize()
+            write_mmchat_players(f"\n\r{{GMultiMUD Status Update: {game} connected to network{{x")
+
+    @grapevine_.on("games/disconnect")
+    def grapevine_game_disconnected(rcvd_msg):
+        if rcvd_msg.result:
+            game = rcvd_msg.result.capitalize()
+            write_mmchat_players(f"\n\r{{GMultiMUD Status Update: {game} disconnected from network{{x")
+
+    @grapevine_.on("channels/broadcast")
+    def grapevine_broadcast(rcvd_msg):
+        if not rcvd_msg.result:
+            return
+        name, game, message = rcvd_msg.result
+        if name == None or game == None:
+            comm.wiznet("Received channels/broadcast with None type")
+            return
+        write_mmchat_players(f"\n\r{{GMultiMUD Chat{{x:{{y{name.capitalize()}"
+                             f"@{game.capitalize()}{{x:{{G{message}{{x")
+
+    # Other games' sign-ins and sign-outs are announced once per game every 10
+    # seconds, so a game reconnecting with a crowd is one line rather than dozens.
+    grapevine_.digest_presence(window=10)
+
+    @grapevine_.on("players/digest")
+    def grapevine_player_digest(rcvd_msg):
+        game = rcvd_msg.payload["game"].capitalize()
+        for inout, names in (("signed into", rcvd_msg.payload["signed_in"]),
+                             ("signed out of", rcvd_msg.payload["signed_out"])):
+            if len(names) == 1:
+                write_mmchat_players(f"\n\r{{GMultiMUD Chat{{x: {{y{names[0]}{{G "
+                                     f"has {inout} {{Y{game}{{x.")
+            elif names:
+                write_mmchat_players(f"\n\r{{GMultiMUD Chat{{x: {{y{len(names)} players{{G "
+                                     f"have {inout} {{Y{game}{{x.")
+
+    @grapevine_.on("restart")
+    def grapevine_restart(rcvd_msg):
+        comm.wiznet("Received restart event from Grapevine.")
+        restart_fuzz = 15 + rcvd_msg.restart_downtime
 
-        if hasattr(rcvd_msg, "event") and rcvd_msg.event == "restart":
-            comm.wiznet("Received restart event from Grapevine.")
-            restart_fuzz = 15 + rcvd_msg.restart_downtime
- 
-            grapevine_.gsocket_disconnect()
+        grapevine_.gsocket_disconnect()
+
+        nextevent = Event()
+        nextevent.owner = grapevine_
+        nextevent.ownertype = "grapevine"
+        nextevent.eventtype = "grapevine restart"
+        nextevent.func = event_grapevine_restart
+        nextevent.passes = restart_fuzz * PULSE_PER_SECOND
+        nextevent.totalpasses = nextevent.passes
+        grapevine_.events.add(nextevent)
+
+    # The client found the connection dead, a ping went unanswered or the socket
+    # dropped, and has already disconnected.  A connect that failed lands here too.
+    # Reconnect shortly.
+    @grapevine_.on("connection/lost")
+    def grapevine_connection_lost(rcvd_msg):
+        comm.wiznet(f"Grapevine: {rcvd_msg.payload['reason']}")
 
-            nextevent = Event()
-            nextevent.owner = grapevine_
-            nextevent.ownertype = "grapevine"
-            nextevent.eventtype = "grapevine restart"
-            nextevent.func = event_grapevine_restart
-            nextevent.passes = restart_fuzz * PULSE_PER_SECOND
-            nextevent.totalpasses = nextevent.passes
-            grapevine_.events.add(nextevent)
+        nextevent = Event()
+        nextevent.owner = grapevine_
+        nextevent.ownertype = "grapevine"
+        nextevent.eventtype = "grapevine restart"
+        nextevent.func = event_grapevine_restart
+        nextevent.passes = 5 * PULSE_PER_SECOND
+        nextevent.totalpasses = nextevent.passes
+        grapevine_.events.add(nextevent)
 
 @reoccuring_event
 def event_grapevine_state_check(event_):
@@ -347,7 +387,7 @@ def event_grapevine_state_check(event_):
 
     if time.time() - grapevine_.last_heartbeat > 60:
         grapevine_.state["connected"] = False
-        grapveine_.state["authenticated"] = False
+        grapevine_.state["authenticated"] = False
 
     if grapevine_.state["connected"] == True:
         grapevine_.msg_gen_player_status_query()
@@ -26,11 +26,16 @@ def mmchat(caller, args, **kwargs):
         return
 
     try:
-        grapevine.gsocket.msg_gen_message_channel_send(caller, "grapevine",  args) 
+        sent = grapevine.gsocket.msg_gen_message_channel_send(caller, "grapevine",  args) 
     except:
         caller.write(f"{{WError chatting to grapevine.haus Network, try again later{{x")
         comm.wiznet(f"Error writing to grapevine.haus network. {caller.name_cap} : {args}")
         return
+
+    # We were rate limited or aren't subscribed, sent says why.
+    if not sent:
+        caller.write(f"{{W{sent}{{x")
+        return
     
     caller.write(f"{{GYou MultiMUD Chat{{x: '{{G{args}{{x'")
 
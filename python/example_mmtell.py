@@ -38,9 +38,11 @@ def mmtell(caller, args, **kwargs):
         caller.write("Just use in game channels to talk to players on Akrios.")
         return
 
-    grapevine.gsocket.msg_gen_player_tells(caller.name_cap, game, target, message)
+    sent = grapevine.gsocket.msg_gen_player_tells(caller.name_cap, game, target, message)
+    if not sent:
+        caller.write(f"{{W{sent}{{x")
+        return
 
-    
     caller.write(f"{{GYou MultiMUD tell {{y{target}@{game}{{x: '{{G{message}{{x'")
 
 
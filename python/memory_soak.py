@@ -0,0 +1,441 @@
+#! /usr/bin/env python3
+# Project: Akrios
+# Filename: memory_soak.py
+#
+# File Description: A soak test for grapevine.py.  Runs a GrapevineSocket against a local
+#                   stand-in for the Grapevine server through a simulated day of traffic
+#                   and fails if memory_report() grows over it.
+#
+# Dependencies: grapevine.py (client.py in this repo) and your keys.py next to this file,
+#               and websocket-client.
+#
+# Usage: python3 memory_soak.py [--hours 24] [--tolerance 0.02] [--seed 1] [--trace]
+#
+# Each simulated minute the stand-in sends a heartbeat, chat, sign-ins and sign-outs of
+# players in other games and tells, while our own players log in and out, chat and send
+# tells.  Games come and go, the player and game status caches are refreshed, and eight
+# hours in the stand-in drops the connection so the client has to reconnect.  grapevine.py
+# runs on a simulated clock, so held presence frames, rate limits, pings and cache
+# expiry all see the day pass, and a day takes seconds.
+#
+# The memory_report() total is taken after the first hours have filled the bounded caches,
+# and again at the end.  More than tolerance growth in between exits with status 1 and
+# lists what grew.  --trace also shows where in grapevine.py the memory was allocated.
+#
+# By: Jubelo, Creator of AkriosMUD
+# At: akriosmud.funcity.org:4000
+#     jubelo@akriosmud.funcity.org
+#
+
+import argparse
+import base64
+import gc
+import hashlib
+import json
+import random
+import socket
+import struct
+import sys
+import time
+
+import grapevine
+
+
+class SimulatedClock(object):
+    '''
+    Stands in for the time module inside grapevine.py.  time() is the simulated clock,
+    moved on by advance(), everything else is the real time module's.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.now = time.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class SoakPlayer(object):
+    '''
+    Stands in for a player of ours, msg_gen_message_channel_send() only needs the name.
+    '''
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+
+class StandInServer(object):
+    '''
+    Just enough of the Grapevine server for the soak test, on a local port.  It takes one
+    connection at a time, completes the websocket upgrade without compression, answers
+    authentication and every request that carries a ref, pongs our pings and sends whatever send() is given.
+    games is the game name to the set of its players online, answers are built from it.
+    '''
+    def __init__(self, games):
+        super().__init__()
+        self.games = games
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.conn = None
+
+    def pump(self):
+        '''
+        Accept, read and answer whatever is waiting, without blocking.
+        '''
+        if self.conn is None:
+            try:
+                self.conn, _ = self.listener.accept()
+            except BlockingIOError:
+                return
+            self.conn.setblocking(False)
+            # A pong held back by Nagle would arrive after simulated seconds had passed.
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.rx = bytearray()
+            self.tx = bytearray()
+            self.upgraded = False
+
+        try:
+            while True:
+                data = self.conn.recv(65536)
+                if not data:
+                    self.drop()
+                    return
+                self.rx += data
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop()
+            return
+
+        if not self.upgraded:
+            head, found, rest = bytes(self.rx).partition(b"\r\n\r\n")
+            if not found:
+                return
+            self.upgrade(head.decode("latin-1"))
+            self.rx = bytearray(rest)
+
+        while True:
+            frame = self.take_frame()
+            if frame is None:
+                break
+            opcode, payload = frame
+            if opcode == 0x1:
+                self.answer(json.loads(payload))
+            elif opcode == 0x9:
+                self.send_frame(0xa, payload)
+            elif opcode == 0x8:
+                self.drop()
+                return
+        self.flush()
+
+    def upgrade(self, request):
+        for each_line in request.split("\r\n")[1:]:
+            name, _, value = each_line.partition(":")
+            if name.strip().lower() == "sec-websocket-key":
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1((key + grapevine.WS_GUID).encode()).digest())
+        self.tx += (b"HTTP/1.1 101 Switching Protocols\r\n"
+                    b"Upgrade: websocket\r\n"
+                    b"Connection: Upgrade\r\n"
+                    b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        self.upgraded = True
+
+    def take_frame(self):
+        '''
+        return (opcode, payload) of the next whole frame we were sent, or None.
+        '''
+        if len(self.rx) < 2:
+            return None
+        length = self.rx[1] & 0x7f
+        offset = 2
+        if length == 126:
+            if len(self.rx) < 4:
+                return None
+            length = struct.unpack_from("!H", self.rx, 2)[0]
+            offset = 4
+        elif length == 127:
+            if len(self.rx) < 10:
+                return None
+            length = struct.unpack_from("!Q", self.rx, 2)[0]
+            offset = 10
+        if len(self.rx) < offset + 4 + length:
+            return None
+        mask = self.rx[offset:offset + 4]
+        data = self.rx[offset + 4:offset + 4 + length]
+        payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(data))
+        opcode = self.rx[0] & 0x0f
+        del self.rx[:offset + 4 + length]
+        return opcode, payload
+
+    def answer(self, msg):
+        event = msg.get("event")
+        ref = msg.get("ref")
+        payload = msg.get("payload") or {}
+        if event == "authenticate":
+            self.send({"event": event, "status": "success",
+                       "payload": {"unicode": "☃", "version": "2.3.0"}})
+            return
+        if ref is None:
+            return
+
+        if event == "players/status":
+            games = [payload["game"]] if "game" in payload else list(self.games)
+            for game in games:
+                if game not in self.games:
+                    self.send({"event": event, "ref": ref, "status": "failure",
+                               "error": "game unknown"})
+                    continue
+                self.send({"event": event, "ref": ref,
+                           "payload": {"game": game, "players": sorted(self.games[game])}})
+        elif event == "games/status":
+            games = [payload["game"]] if "game" in payload else list(self.games)
+            for game in games:
+                if game not in self.games:
+                    self.send({"event": event, "ref": ref, "status": "failure",
+                               "error": "game unknown"})
+                    continue
+                self.send({"event": event, "ref": ref, "status": "success",
+                           "payload": {"game": game,
+                                       "display_name": game,
+                                       "description": f"The {game} soak test game.",
+                                       "homepage_url": f"https://{game.lower()}.example",
+                                       "user_agent": "soak",
+                                       "user_agent_repo_url": None,
+                                       "connections": [],
+                                       "supports": ["channels", "players", "tells"],
+                                       "players_online_count": len(self.games[game])}})
+        else:
+            self.send({"event": event, "ref": ref, "status": "success"})
+
+    def send(self, msg):
+        if self.conn is not None and self.upgraded:
+            self.send_frame(0x1, json.dumps(msg).encode())
+
+    def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        self.tx += header + payload
+
+    def flush(self):
+        try:
+            while self.conn is not None and self.tx:
+                del self.tx[:self.conn.send(self.tx)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop()
+
+    def drop(self):
+        '''
+        Close the connection, the client finds out on its next read.
+        '''
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+
+class Soak(object):
+    '''
+    Drives a GrapevineSocket and a StandInServer through simulated minutes of traffic.
+    '''
+    def __init__(self, seed=1, games=20, players_per_game=60, our_players=40):
+        super().__init__()
+        self.random = random.Random(seed)
+        self.roster = [f"Game{number}" for number in range(games)]
+        self.population = {game: [f"{game}player{number}" for number in range(players_per_game)]
+                           for game in self.roster}
+        self.games = {game: set(self.random.sample(names, players_per_game // 2))
+                      for game, names in self.population.items()}
+        self.offline_games = set()
+        self.our_population = [f"Soaker{number}" for number in range(our_players)]
+        self.online = set(self.random.sample(self.our_population, our_players // 2))
+
+        self.clock = SimulatedClock()
+        grapevine.time = self.clock
+        self.server = StandInServer(self.games)
+        self.gsock = grapevine.GrapevineSocket()
+        self.gsock.url = f"ws://127.0.0.1:{self.server.port}/socket"
+        self.gsock.player_list_func = lambda: sorted(self.online)
+        self.lost = 0
+
+        @self.gsock.on("connection/lost")
+        def soak_connection_lost(rcvd_msg):
+            self.lost += 1
+
+        # A blocking handler, so the handler pool is part of the soak too.
+        @self.gsock.on("tells/receive", blocking=True)
+        def soak_tell_log(rcvd_msg):
+            return rcvd_msg.result
+
+        self.connect()
+
+    def connect(self):
+        self.gsock.gsocket_connect()
+        deadline = time.time() + 10
+        while not self.gsock.state["connected"] or self.gsock.subscribed.get("gossip") is not True:
+            if time.time() > deadline:
+                raise RuntimeError(f"Could not connect to the stand-in server: "
+                                   f"{self.gsock.connect_state} {self.gsock.connect_error}")
+            self.pulse()
+            time.sleep(0.001)
+
+    def pulse(self):
+        '''
+        One pass of the game loop, as in example_event_sys_with_grapevine.py, with the
+        stand-in server taking its turn in between.
+        '''
+        self.server.pump()
+        self.gsock.handle_read()
+        self.gsock.process_pending()
+        if self.gsock.wants_write():
+            self.gsock.handle_write()
+        self.server.pump()
+
+    def minute(self, number):
+        '''
+        Run simulated minute number.
+        '''
+        server = self.server
+        gsock = self.gsock
+        pick = self.random
+        if gsock.connect_state in ("closed", "failed"):
+            self.connect()
+
+        server.send({"event": "heartbeat"})
+        for _ in range(20):
+            game = pick.choice(self.roster)
+            if game in self.offline_games:
+                continue
+            server.send({"event": "channels/broadcast",
+                         "payload": {"channel": "gossip", "game": game,
+                                     "name": pick.choice(self.population[game]),
+                                     "message": "soak chat line"}})
+        # Players come and go in pairs, so how many are online holds steady and any
+        # growth is the client's.
+        for _ in range(5):
+            game = pick.choice(self.roster)
+            if game in self.offline_games:
+                continue
+            leaving = pick.choice(sorted(self.games[game]))
+            coming = pick.choice([name for name in self.population[game]
+                                  if name not in self.games[game]])
+            self.games[game].discard(leaving)
+            self.games[game].add(coming)
+            server.send({"event": "players/sign-out", "payload": {"game": game, "name": leaving}})
+            server.send({"event": "players/sign-in", "payload": {"game": game, "name": coming}})
+        game = pick.choice(self.roster)
+        server.send({"event": "tells/receive",
+                     "payload": {"from_game": game,
+                                 "from_name": pick.choice(self.population[game]),
+                                 "to_name": pick.choice(sorted(self.online)),
+                                 "sent_at": "2019-01-01T00:00:00Z",
+                                 "message": "soak tell"}})
+
+        leaving = pick.choice(sorted(self.online))
+        coming = pick.choice([name for name in self.our_population if name not in self.online])
+        self.online.discard(leaving)
+        gsock.msg_gen_player_logout(leaving)
+        self.online.add(coming)
+        gsock.msg_gen_player_login(coming)
+        for name in pick.sample(sorted(self.online), min(3, len(self.online))):
+            gsock.msg_gen_message_channel_send(SoakPlayer(name), "gossip", "soak chat")
+        game = pick.choice(self.roster)
+        gsock.msg_gen_player_tells(pick.choice(sorted(self.online)), game,
+                                   pick.choice(self.population[game]), "soak tell")
+
+        # A game leaves every hour and comes back half an hour later.
+        if number % 30 == 0:
+            if self.offline_games:
+                game = self.offline_games.pop()
+                names = self.population[game]
+                self.games[game] = set(pick.sample(names, len(names) // 2))
+                server.send({"event": "games/connect", "payload": {"game": game}})
+            else:
+                game = pick.choice(self.roster)
+                self.offline_games.add(game)
+                self.games.pop(game)
+                server.send({"event": "games/disconnect", "payload": {"game": game}})
+        if number % 15 == 0:
+            gsock.refresh_player_status()
+        if number % 60 == 0:
+            gsock.refresh_game_directory()
+
+        # The rest of the minute, a pulse every five seconds.
+        for _ in range(12):
+            self.pulse()
+            self.clock.advance(5)
+
+        # Eight hours in Grapevine restarts, we reconnect next minute.
+        if number == 480:
+            server.drop()
+
+    def measure(self):
+        gc.collect()
+        return self.gsock.memory_report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test grapevine.py for memory growth.")
+    parser.add_argument("--hours", type=float, default=24, help="simulated hours to run")
+    parser.add_argument("--warmup", type=float, default=2,
+                        help="simulated hours before the baseline is taken")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="growth over the baseline allowed, as a fraction")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace", action="store_true",
+                        help="attribute what grew to lines of grapevine.py with tracemalloc")
+    args = parser.parse_args()
+
+    soak = Soak(seed=args.seed)
+    minutes = int(args.hours * 60)
+    warmup = min(int(args.warmup * 60), minutes)
+    started = time.time()
+
+    for number in range(warmup):
+        soak.minute(number)
+    baseline = soak.measure()
+    if args.trace:
+        soak.gsock.memory_report(trace=True)
+
+    for number in range(warmup, minutes):
+        soak.minute(number)
+    final = soak.measure()
+    traced = soak.gsock.memory_report(trace=True)["traced"] if args.trace else []
+
+    growth = final["total"]["bytes"] - baseline["total"]["bytes"]
+    allowed = baseline["total"]["bytes"] * args.tolerance
+    print(f"{args.hours:g} simulated hours in {time.time() - started:.1f}s, "
+          f"{soak.lost} connections lost, {soak.gsock.stats['frames_in']} frames in and "
+          f"{soak.gsock.stats['frames_out']} out")
+    print(f"{'':24}{'baseline':>12}{'final':>12}{'entries':>16}")
+    for name in final:
+        print(f"{name:24}{baseline[name]['bytes']:>12}{final[name]['bytes']:>12}"
+              f"{baseline[name]['entries']:>8}{final[name]['entries']:>8}")
+    for filename, size, count in traced:
+        print(f"traced {filename} {size} bytes in {count} blocks")
+
+    if growth > allowed:
+        print(f"FAIL: memory grew {growth} bytes, more than the {allowed:.0f} allowed")
+        soak.gsock.stop_threads()
+        return 1
+    print(f"OK: memory grew {growth} bytes, within the {allowed:.0f} allowed")
+    soak.gsock.stop_threads()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())